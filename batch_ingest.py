@@ -0,0 +1,119 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from os import path, remove
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import h5py
+
+from creation import write_export
+
+default_pattern = 'Exc_spectra_T_map_*.txt'
+
+
+class IngestResult:
+    def __init__(self, source, hdf_name, hdf_file_path=None, seconds=0.0, error=None):
+        self.source = source
+        self.hdf_name = hdf_name
+        self.hdf_file_path = hdf_file_path
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def find_exports(source, pattern=default_pattern):
+    if path.isdir(source):
+        source = path.join(source, pattern)
+    return sorted(glob(source))
+
+
+def ingest_file(file_path, output_directory=None):
+    hdf_name = path.splitext(path.basename(file_path))[0]
+    if output_directory is None:
+        output_directory = path.dirname(file_path)
+    hdf_file_path = path.join(output_directory, hdf_name + '.hdf5')
+    start = perf_counter()
+    try:
+        with h5py.File(hdf_file_path, 'w') as hdf_file:
+            write_export(file_path, hdf_file.create_group(hdf_name), hdf_name)
+    except Exception as e:
+        if path.exists(hdf_file_path):
+            remove(hdf_file_path)
+        return IngestResult(file_path, hdf_name, seconds=perf_counter() - start, error=f'{type(e).__name__}: {e}')
+    return IngestResult(file_path, hdf_name, hdf_file_path, perf_counter() - start)
+
+
+def batch_ingest(file_paths, output_directory=None, consolidated_file_path=None, workers=None):
+    """Converts exports to HDF5 in a process pool. With consolidated_file_path every map is written as its own
+    group of a single HDF5 file, otherwise one file per map is created in output_directory (or next to the source)."""
+    results = []
+    with TemporaryDirectory() as temporary_directory:
+        if consolidated_file_path is not None:
+            output_directory = temporary_directory
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(ingest_file, file_path, output_directory) for file_path in file_paths]
+            for future in as_completed(futures):
+                results.append(future.result())
+        results.sort(key=lambda result: file_paths.index(result.source))
+
+        if consolidated_file_path is not None:
+            with h5py.File(consolidated_file_path, 'a') as consolidated_file:
+                for result in results:
+                    if not result.ok:
+                        continue
+                    if result.hdf_name in consolidated_file:
+                        del consolidated_file[result.hdf_name]
+                    with h5py.File(result.hdf_file_path, 'r') as map_file:
+                        map_file.copy(map_file[result.hdf_name], consolidated_file)
+                    result.hdf_file_path = consolidated_file_path
+    return results
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Convert spectrometer temperature map exports to HDF5.')
+    parser.add_argument('source', help='directory with exports or a glob pattern')
+    parser.add_argument('--pattern', default=default_pattern, help='file pattern used when source is a directory')
+    parser.add_argument('--output', default=None, help='directory for per-map HDF5 files (default: next to sources)')
+    parser.add_argument('--consolidated', default=None, help='write all maps as groups of this single HDF5 file')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--catalog', default=None, help='add the converted maps to this SQLite catalog')
+    arguments = parser.parse_args(arguments)
+
+    file_paths = find_exports(arguments.source, arguments.pattern)
+    if not file_paths:
+        print(f'No exports found for {arguments.source}')
+        return 1
+    start = perf_counter()
+    results = batch_ingest(file_paths, arguments.output, arguments.consolidated, arguments.workers)
+    for result in results:
+        status = 'ok' if result.ok else f'FAILED {result.error}'
+        print(f'{result.seconds:8.3f} s  {path.basename(result.source)}  {status}')
+    failures = [result for result in results if not result.ok]
+    print(f'{len(results) - len(failures)}/{len(results)} maps converted in {perf_counter() - start:.3f} s')
+    if arguments.catalog is not None:
+        from catalog import Catalog
+        with Catalog(arguments.catalog) as catalog:
+            for hdf_file_path in sorted({result.hdf_file_path for result in results if result.ok}):
+                catalog.index_file(hdf_file_path)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import json
+import sys
+import tracemalloc
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from fitting_functions import dict_of_fitting_functions, dict_of_fitting_jacobians, dict_of_fitting_limits, \
+    single_mott_seitz
+
+synthetic_parameters = {
+    'Single Mott-Seitz': (1.2, 50.0, 400.0),
+    'Double Mott-Seitz': (1.2, 30.0, 500.0, 300.0, 900.0),
+    'Linear': (-0.004, 1.5),
+    'Exponential decay': (2.0, 200.0),
+    'coth': (1.0, 300.0, 0.5)
+}
+readout_values = 1_000_000
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def benchmark_fitting(repeats=5, temperatures=None, noise=0.002, seed=0):
+    """Fit time of every model with finite-difference and analytic Jacobians on noisy synthetic calibration curves."""
+    rng = np.random.default_rng(seed)
+    if temperatures is None:
+        temperatures = np.arange(30.0, 301.0, 10.0)
+    results = []
+    for model, parameters in synthetic_parameters.items():
+        function = dict_of_fitting_functions[model]
+        parameter = function(temperatures, *parameters)
+        parameter = parameter * (1 + rng.normal(0, noise, len(temperatures)))
+        initial_parameters = [value * 0.8 for value in parameters]
+
+        def fit(jac):
+            return curve_fit(function, temperatures, parameter, p0=initial_parameters,
+                             bounds=dict_of_fitting_limits[model], jac=jac)
+
+        finite_difference = best_time(lambda: fit('2-point'), repeats)
+        analytic = best_time(lambda: fit(dict_of_fitting_jacobians[model]), repeats)
+        results.append((model, finite_difference, analytic))
+    return results
+
+
+def synthetic_map(number_of_wavelengths=2000, number_of_temperatures=28, wavelength_range=(500.0, 700.0),
+                  temperature_range=(30.0, 300.0), noise=0.02, seed=0):
+    """Map with two Gaussian peaks: the first is quenched following Mott-Seitz behaviour (synthetic_parameters), the
+    second does not depend on temperature, so their ratio is a single Mott-Seitz calibration curve. noise is the
+    standard deviation relative to the peak height. Returns wavelengths, temperatures and (wavelengths x temperatures)
+    intensities."""
+    rng = np.random.default_rng(seed)
+    x_data = np.linspace(*wavelength_range, number_of_wavelengths)
+    temperatures = np.linspace(*temperature_range, number_of_temperatures)
+    width = (wavelength_range[1] - wavelength_range[0]) / 40
+    first_centre, second_centre = np.quantile(x_data, [2 / 3, 1 / 3])
+    first_peak = np.exp(-0.5 * ((x_data - first_centre) / width)**2)
+    second_peak = np.exp(-0.5 * ((x_data - second_centre) / width)**2)
+    delta0, a1, e1 = synthetic_parameters['Single Mott-Seitz']
+    height = 1000.0
+    intensities = height * (first_peak[:, np.newaxis] * single_mott_seitz(temperatures, delta0, a1, e1) +
+                            second_peak[:, np.newaxis] + 0.01)
+    intensities += rng.normal(0.0, noise * height, intensities.shape)
+    return x_data, temperatures, intensities
+
+
+def write_synthetic_export(file_path, rows_per_block=8192, **map_options):
+    """Writes synthetic_map(**map_options) in the spectrometer export format read by creation.new and returns the
+    wavelengths of the two peaks (numerator, denominator)."""
+    x_data, temperatures, intensities = synthetic_map(**map_options)
+    labels = ''.join(f'S{index},' for index in range(len(temperatures)))
+    with open(file_path, 'w') as file:
+        file.write('"Synthetic map"\n\n')
+        file.write(f'Labels,{labels}\n')
+        file.write('Temp,' + ''.join(f'{temperature},' for temperature in temperatures) + '\n')
+        file.write('Detector,' + 'PMT,' * len(temperatures) + '\n')
+        for start in range(0, len(x_data), rows_per_block):
+            block = np.column_stack((x_data[start:start + rows_per_block], intensities[start:start + rows_per_block]))
+            np.savetxt(file, block, fmt='%.4f', delimiter=',', newline=',\n')
+    first_centre, second_centre = np.quantile(x_data, [2 / 3, 1 / 3])
+    return x_data[np.abs(x_data - first_centre).argmin()], x_data[np.abs(x_data - second_centre).argmin()]
+
+
+def measure(function, repeats):
+    """Best time of repeats runs and the peak of memory traced by tracemalloc during one extra run, which is kept
+    separate as tracing slows the code down. Returns time / s, peak / bytes and the result of the last run."""
+    seconds = best_time(function, repeats)
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def benchmark_pipeline(directory, repeats=3, window_length=11, polyorder=3, **map_options):
+    """Times every step of the analysis of a synthetic map written to directory. Returns {stage: (time / s,
+    peak memory / bytes)}; fits that do not converge have a NaN time. The readout stage converts readout_values
+    thermometric parameters back to temperatures."""
+    from creation import new
+    from fitting import fit_model
+    from pipeline import Analysis
+    from readout import Calibration
+
+    export_path = path.join(directory, 'synthetic_map.txt')
+    first, second = write_synthetic_export(export_path, **map_options)
+    results = {}
+
+    def ingest():
+        thermmap = new(export_path, 'synthetic_map', reuse=False)
+        thermmap.file.close()
+
+    results['ingest'] = measure(ingest, repeats)[:2]
+    thermmap = new(export_path, 'synthetic_map')
+    thermmap.get_temperatures()
+    results['get_data'] = measure(thermmap.get_data, repeats)[:2]
+    results['normalize'] = measure(lambda: thermmap.normalize(second), repeats)[:2]
+    results['smooth'] = measure(lambda: thermmap.smooth(window_length, polyorder), repeats)[:2]
+    results['ratio'] = measure(lambda: thermmap.ratio(first, second), repeats)[:2]
+    parameter = thermmap.ratio(first, second)
+    for model, parameters in synthetic_parameters.items():
+        def fit():
+            return fit_model(model, thermmap.temperatures, parameter, parameters)
+        try:
+            results[f'fit {model}'] = measure(fit, repeats)[:2]
+        except (RuntimeError, ValueError):
+            results[f'fit {model}'] = (float('nan'), 0)
+
+    analysis = Analysis(thermmap, first, second)
+    analysis.fit('Single Mott-Seitz', list(synthetic_parameters['Single Mott-Seitz']))
+    analysis.determine_error(window_length, polyorder)
+    results['export'] = measure(lambda: analysis.export(path.join(directory, 'synthetic_map.csv')), repeats)[:2]
+    calibration = Calibration.from_analysis(analysis)
+    values = np.resize(parameter, readout_values)
+    results['readout'] = measure(lambda: calibration.temperature(values), repeats)[:2]
+    thermmap.file.close()
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """Stages whose time or peak memory exceeds the baseline by more than the tolerance fraction, as
+    (stage, quantity, value, baseline value) tuples."""
+    regressions = []
+    for stage, (seconds, peak) in results.items():
+        if stage not in baseline:
+            continue
+        for quantity, value, reference in (('time', seconds, baseline[stage]['time']),
+                                           ('peak_memory', peak, baseline[stage]['peak_memory'])):
+            if value > reference * (1 + tolerance):
+                regressions.append((stage, quantity, value, reference))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='ThermLUM performance benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    fitting_parser = subparsers.add_parser('fitting', help='fit time per model, finite-difference vs analytic Jacobian')
+    fitting_parser.add_argument('--repeats', type=int, default=5)
+    pipeline_parser = subparsers.add_parser('pipeline', help='time and peak memory of every analysis step on a synthetic map')
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic map in the spectrometer export format')
+    generate_parser.add_argument('output', help='export file to write')
+    for map_parser in (pipeline_parser, generate_parser):
+        map_parser.add_argument('--wavelengths', type=int, default=2000)
+        map_parser.add_argument('--temperatures', type=int, default=28)
+        map_parser.add_argument('--noise', type=float, default=0.02, help='noise relative to the peak height')
+        map_parser.add_argument('--seed', type=int, default=0)
+    pipeline_parser.add_argument('--repeats', type=int, default=3)
+    pipeline_parser.add_argument('--baseline', default=None, help='JSON file of a previous run to compare against')
+    pipeline_parser.add_argument('--save-baseline', default=None, help='store the results in this JSON file')
+    pipeline_parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow-down before a regression is reported')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.benchmark == 'fitting':
+        print('model               finite diff. / ms  analytic / ms  speed-up')
+        for model, finite_difference, analytic in benchmark_fitting(arguments.repeats):
+            print(f'{model:18}  {finite_difference * 1e3:17.2f}  {analytic * 1e3:13.2f}  {finite_difference / analytic:8.2f}')
+        return 0
+
+    map_options = dict(number_of_wavelengths=arguments.wavelengths, number_of_temperatures=arguments.temperatures,
+                       noise=arguments.noise, seed=arguments.seed)
+    if arguments.benchmark == 'generate':
+        first, second = write_synthetic_export(arguments.output, **map_options)
+        print(f'{arguments.output}: ratio {first:.2f} nm / {second:.2f} nm follows {synthetic_parameters["Single Mott-Seitz"]}')
+        return 0
+
+    with TemporaryDirectory() as directory:
+        results = benchmark_pipeline(directory, arguments.repeats, **map_options)
+    print(f'{arguments.wavelengths} wavelengths x {arguments.temperatures} temperatures')
+    print('stage                     time / ms  peak memory / MB')
+    for stage, (seconds, peak) in results.items():
+        print(f'{stage:24}  {seconds * 1e3:9.2f}  {peak / 1024**2:16.2f}')
+    exit_code = 0
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        for stage, quantity, value, reference in compare_to_baseline(results, baseline['results'], arguments.tolerance):
+            print(f'REGRESSION {stage} {quantity}: {value:.4g} vs baseline {reference:.4g}')
+            exit_code = 1
+    if arguments.save_baseline is not None:
+        with open(arguments.save_baseline, 'w') as baseline_file:
+            json.dump({'map': map_options, 'repeats': arguments.repeats,
+                       'results': {stage: {'time': seconds, 'peak_memory': peak}
+                                   for stage, (seconds, peak) in results.items()}},
+                      baseline_file, indent=1)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
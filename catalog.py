@@ -0,0 +1,260 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import json
+import sqlite3
+import sys
+from glob import glob
+from os import path, stat
+from time import time
+
+import h5py
+import numpy as np
+
+from fitting_functions import dict_of_fitting_functions
+from sensitivity import relative_sensitivity
+from utilities import WavelengthIndex
+
+default_database = 'thermlum_catalog.sqlite'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    file_path TEXT PRIMARY KEY,
+    file_size INTEGER,
+    file_mtime INTEGER,
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS maps (
+    id INTEGER PRIMARY KEY,
+    file_path TEXT NOT NULL REFERENCES files (file_path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    source_hash TEXT,
+    wavelength_min REAL,
+    wavelength_max REAL,
+    number_of_wavelengths INTEGER,
+    resolution REAL,
+    temperature_min REAL,
+    temperature_max REAL,
+    number_of_temperatures INTEGER,
+    temperatures TEXT,
+    UNIQUE (file_path, name)
+);
+CREATE TABLE IF NOT EXISTS derived (
+    map_id INTEGER NOT NULL REFERENCES maps (id) ON DELETE CASCADE,
+    operation TEXT,
+    parameters TEXT,
+    nbytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS fits (
+    map_id INTEGER NOT NULL REFERENCES maps (id) ON DELETE CASCADE,
+    model TEXT,
+    first REAL,
+    second REAL,
+    parameters TEXT,
+    errors TEXT,
+    max_sensitivity REAL,
+    temperature_of_max_sensitivity REAL
+);
+CREATE INDEX IF NOT EXISTS maps_temperatures ON maps (temperature_min, temperature_max);
+CREATE INDEX IF NOT EXISTS maps_wavelengths ON maps (wavelength_min, wavelength_max);
+CREATE INDEX IF NOT EXISTS maps_file ON maps (file_path);
+CREATE INDEX IF NOT EXISTS derived_map ON derived (map_id);
+CREATE INDEX IF NOT EXISTS fits_map ON fits (map_id);
+CREATE INDEX IF NOT EXISTS fits_sensitivity ON fits (max_sensitivity);
+'''
+
+
+def describe_map(group, name):
+    """Catalog row of a map group and its cached fits, read without loading the spectra."""
+    data = group[f'data_{name}']
+    temperatures = group[f'temperatures_{name}'][...].astype(np.float64)
+    x_data = data[:, 0].astype(np.float64)
+    description = {
+        'name': name,
+        'source_hash': data.attrs.get('source_hash'),
+        'wavelength_min': float(x_data.min()) if len(x_data) else None,
+        'wavelength_max': float(x_data.max()) if len(x_data) else None,
+        'number_of_wavelengths': len(x_data),
+        'resolution': WavelengthIndex(x_data).resolution if len(x_data) > 1 else None,
+        'temperature_min': float(temperatures.min()) if len(temperatures) else None,
+        'temperature_max': float(temperatures.max()) if len(temperatures) else None,
+        'number_of_temperatures': len(temperatures),
+        'temperatures': json.dumps(temperatures.tolist())
+    }
+    derived, fits = [], []
+    for entry in group.get(f'derived_{name}', {}).values():
+        operation = entry.attrs.get('operation')
+        derived.append((operation, entry.attrs.get('parameters'), int(entry.attrs.get('nbytes', 0))))
+        if operation == 'fit' and 'fitted_parameters' in entry:
+            fits.append(describe_fit(json.loads(entry.attrs['parameters']), entry, temperatures))
+    return description, derived, fits
+
+
+def describe_fit(fit_parameters, entry, temperatures):
+    model = fit_parameters['model']
+    parameters = entry['fitted_parameters'][...]
+    errors = np.sqrt(np.diag(entry['covariance'][...])) if 'covariance' in entry else np.full(len(parameters), np.nan)
+    max_sensitivity, temperature_of_max = None, None
+    if model in dict_of_fitting_functions and len(temperatures):
+        fit_x = np.linspace(temperatures.min(), temperatures.max(), 1000)
+        with np.errstate(all='ignore'):
+            sensitivity = relative_sensitivity(model, fit_x, parameters)
+        if np.isfinite(sensitivity).any():
+            best = int(np.nanargmax(sensitivity))
+            max_sensitivity, temperature_of_max = float(sensitivity[best]), float(fit_x[best])
+    return (model, fit_parameters.get('first'), fit_parameters.get('second'), json.dumps(parameters.tolist()),
+            json.dumps(errors.tolist()), max_sensitivity, temperature_of_max)
+
+
+class Catalog:
+    """SQLite index of converted maps. update() only re-reads HDF5 files whose size or modification time changed
+    since they were indexed, queries never open an HDF5 file."""
+    def __init__(self, database_path=default_database):
+        self.connection = sqlite3.connect(database_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def is_current(self, file_path, status):
+        row = self.connection.execute('SELECT file_size, file_mtime FROM files WHERE file_path = ?',
+                                      (file_path,)).fetchone()
+        return row is not None and row['file_size'] == status.st_size and row['file_mtime'] == status.st_mtime_ns
+
+    def index_file(self, file_path):
+        """(Re-)indexes every map group of an HDF5 file, returns the number of maps found."""
+        file_path = path.abspath(file_path)
+        status = stat(file_path)
+        rows = []
+        with h5py.File(file_path, 'r') as hdf_file:
+            for name, group in hdf_file.items():
+                if isinstance(group, h5py.Group) and f'data_{name}' in group:
+                    rows.append(describe_map(group, name))
+        with self.connection:
+            # files without any map are kept as well, so they are not opened again until they change
+            self.connection.execute('DELETE FROM files WHERE file_path = ?', (file_path,))
+            self.connection.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                                    (file_path, status.st_size, status.st_mtime_ns, time()))
+            for description, derived, fits in rows:
+                columns = dict(description, file_path=file_path)
+                map_id = self.connection.execute(
+                    f'INSERT INTO maps ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                    list(columns.values())).lastrowid
+                self.connection.executemany('INSERT INTO derived VALUES (?, ?, ?, ?)',
+                                            [(map_id, *entry) for entry in derived])
+                self.connection.executemany('INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                            [(map_id, *fit) for fit in fits])
+        return len(rows)
+
+    def update(self, directories, pattern='**/*.hdf5'):
+        """Indexes new and changed HDF5 files below directories and drops files that no longer exist there. Returns
+        the paths of the files that were (re-)indexed and (path, error) pairs of the files that could not be read."""
+        indexed = []
+        failures = []
+        for directory in directories:
+            directory = path.abspath(directory)
+            found = set()
+            for file_path in glob(path.join(directory, pattern), recursive=True):
+                found.add(file_path)
+                status = stat(file_path)
+                if self.is_current(file_path, status):
+                    continue
+                try:
+                    self.index_file(file_path)
+                except (OSError, KeyError) as e:
+                    failures.append((file_path, e))
+                    continue
+                indexed.append(file_path)
+            # a plain prefix comparison, LIKE would treat '_' and '%' in directory names as wildcards
+            prefix = path.join(directory, '')
+            stored = self.connection.execute('SELECT file_path FROM files WHERE substr(file_path, 1, length(?)) = ?',
+                                             (prefix, prefix)).fetchall()
+            with self.connection:
+                self.connection.executemany('DELETE FROM files WHERE file_path = ?',
+                                            [(row['file_path'],) for row in stored if row['file_path'] not in found])
+        return indexed, failures
+
+    def query(self, temperatures=None, wavelengths=None, min_sensitivity=None, model=None, name=None):
+        """Maps covering the temperature range and the wavelength range (both (min, max)), whose name matches the SQL
+        LIKE pattern name. With min_sensitivity or model only maps with a matching cached fit are returned, one row
+        per fit."""
+        conditions, arguments = [], []
+        if temperatures is not None:
+            conditions.append('maps.temperature_min <= ? AND maps.temperature_max >= ?')
+            arguments += [temperatures[0], temperatures[1]]
+        if wavelengths is not None:
+            conditions.append('maps.wavelength_min <= ? AND maps.wavelength_max >= ?')
+            arguments += [wavelengths[0], wavelengths[1]]
+        if name is not None:
+            conditions.append('maps.name LIKE ?')
+            arguments.append(name)
+        join = 'LEFT JOIN'
+        if min_sensitivity is not None:
+            conditions.append('fits.max_sensitivity >= ?')
+            arguments.append(min_sensitivity)
+            join = 'JOIN'
+        if model is not None:
+            conditions.append('fits.model = ?')
+            arguments.append(model)
+            join = 'JOIN'
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        rows = self.connection.execute(
+            f'SELECT maps.*, fits.model, fits.first, fits.second, fits.parameters, fits.errors, fits.max_sensitivity, '
+            f'fits.temperature_of_max_sensitivity FROM maps {join} fits ON fits.map_id = maps.id {where} '
+            f'ORDER BY fits.max_sensitivity DESC, maps.file_path', arguments).fetchall()
+        return [dict(row) for row in rows]
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Index converted ThermLUM maps and search them.')
+    parser.add_argument('--database', default=default_database)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help='add new and changed .hdf5 maps below the directories')
+    index_parser.add_argument('directories', nargs='+')
+    query_parser = subparsers.add_parser('query', help='list maps matching all given conditions')
+    query_parser.add_argument('--temperatures', nargs=2, type=float, metavar=('MIN', 'MAX'), help='range the map must cover / K')
+    query_parser.add_argument('--wavelengths', nargs=2, type=float, metavar=('MIN', 'MAX'), help='range the map must cover / nm')
+    query_parser.add_argument('--min-sensitivity', type=float, default=None, help='minimum max. Sr of a cached fit / %%K^-1')
+    query_parser.add_argument('--model', default=None, choices=list(dict_of_fitting_functions))
+    query_parser.add_argument('--name', default=None, help='SQL LIKE pattern of the map name')
+    arguments = parser.parse_args(arguments)
+
+    with Catalog(arguments.database) as catalog:
+        if arguments.command == 'index':
+            indexed, failures = catalog.update(arguments.directories)
+            for file_path, error in failures:
+                print(f'{file_path}: not indexed, {type(error).__name__}: {error}')
+            print(f'{len(indexed)} files (re-)indexed')
+            return 1 if failures else 0
+        rows = catalog.query(arguments.temperatures, arguments.wavelengths, arguments.min_sensitivity,
+                             arguments.model, arguments.name)
+    for row in rows:
+        fit = ''
+        if row['model'] is not None:
+            sensitivity = 'n/a' if row['max_sensitivity'] is None else f'{row["max_sensitivity"]:.3f} %/K'
+            fit = f'  {row["model"]} {row["first"]}/{row["second"]} nm, max Sr {sensitivity}'
+        print(f'{row["file_path"]} [{row["name"]}] {row["wavelength_min"]:g}-{row["wavelength_max"]:g} nm, '
+              f'{row["temperature_min"]:g}-{row["temperature_max"]:g} K{fit}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,5 @@
 # ThermLUM - luminescent thermometry data analysis application
-# Copyright (C) 2024  Hubert Dzielak 
+# Copyright (C) 2024  Hubert Dzielak
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -12,47 +12,170 @@
 # GNU General Public License for more details.
 import pandas as pd
 import h5py
-from os import path, remove
-def new(file_path, hdf_name):
-    file_directory, file_name = path.split(file_path)
-    with open(file_path, "r") as file:
-        lines_list = file.readlines()
-    for index, line in enumerate(lines_list):
-        if 'Labels' in line:
-            start_description_index = index
+import numpy as np
+from hashlib import blake2b
+from io import BufferedReader, RawIOBase, TextIOWrapper
+from os import path, fstat, stat
+
+from derived_cache import map_hasher, hash_update, finish_map_hash
+from profiling import profiled
+
+block_rows = 8192  # rows parsed and written at once, bounds memory used during ingest
+chunk_bytes = 64 * 1024  # target size of a single HDF5 chunk
+chunk_columns = 32
+
+
+def chunk_shape(n_columns):
+    columns = min(n_columns, chunk_columns)
+    rows = max(1, chunk_bytes // (8 * columns))
+    return rows, columns
+
+
+def read_export_header(file):
+    """Reads the 'Labels'...'Detector' description block and returns the temperatures. Leaves the file
+    positioned at the first line of the numeric block."""
+    labels_found = False
+    temperatures = None
+    for line in iter(file.readline, ''):
+        if not labels_found:
+            labels_found = 'Labels' in line
+            continue
+        cells = line.strip().rstrip(',').split(',')
+        if cells[0] == 'Temp':
+            temperatures = np.array(cells[1:], dtype=np.float64)
         if 'Detector' in line:
-            end_description_index = index
-
-    description_contents = ''
-    for line in lines_list[start_description_index:end_description_index + 1]:
-        description_contents += line
-    with open(path.join(file_directory, f'description_{file_name.split('.')[0]}'), 'w') as description_file:
-        description_file.write(description_contents)
-
-    description_df = pd.read_csv(description_file.name, sep=',')
-    temps_row = description_df[description_df.iloc[:, 0] == 'Temp']
-    temps = temps_row.iloc[:, 1:-1].to_numpy()[0]
-
-    data_contents = ''
-    for line in lines_list[end_description_index + 1:]:
-        data_contents += line
-    with open(path.join(file_directory, f'_temp_data)_{file_name.split('.')[0]}.csv'), 'w') as data_file:
-        data_file.write(data_contents)
-
-    data_df = pd.read_csv(data_file.name, sep=',', header=None)
-    data_df = data_df.iloc[:, :-1] # index -1 removes nan column previously containing new line symbols
-
-    hdf_file_path = path.join(file_directory, hdf_name+'.hdf5')
-    hdf_file = h5py.File(hdf_file_path, 'w')
-    group = hdf_file.create_group(hdf_name)
-    group.create_dataset(f'data_{hdf_name}', data=data_df)
-    group.create_dataset(f'temperatures_{hdf_name}', data=temps)
-    hdf_file.close()
-
-    if path.exists(path.join(file_directory, f'description_{file_name.split('.')[0]}')): 
-        remove(path.join(file_directory, f'description_{file_name.split('.')[0]}'))
-    if path.exists(path.join(file_directory, f'_temp_data)_{file_name.split('.')[0]}.csv')): 
-        remove(path.join(file_directory, f'_temp_data)_{file_name.split('.')[0]}.csv'))
+            break
+    else:
+        raise ValueError(f"'Labels' and 'Detector' rows not found in {file.name}")
+    if temperatures is None:
+        raise ValueError(f"'Temp' row not found in {file.name}")
+    return temperatures
+
+
+class _HashingReader(RawIOBase):
+    """Raw binary file that feeds every byte read into hasher, so the export is hashed by the same pass that parses it."""
+    def __init__(self, file, hasher):
+        self.file = file
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.file.readinto(buffer)
+        if size:
+            self.hasher.update(memoryview(buffer)[:size])
+        return size
+
+    def tell(self):
+        return self.file.tell()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+        super(_HashingReader, self).close()
+
+
+@profiled('creation.write_export')
+def write_export(file_path, group, hdf_name, rows_per_block=block_rows, progress=None):
+    """Streams a spectrometer export into chunked datasets of an open HDF5 group in one pass. progress, if given, is
+    called with the fraction of the file read after every block."""
+    file_hasher = blake2b(digest_size=16)
+    with TextIOWrapper(BufferedReader(_HashingReader(open(file_path, 'rb', buffering=0), file_hasher))) as file:
+        file_size = max(fstat(file.fileno()).st_size, 1)
+        temps = read_export_header(file)
+        n_columns = len(temps) + 1
+        data = group.create_dataset(
+            f'data_{hdf_name}',
+            shape=(0, n_columns),
+            maxshape=(None, None),
+            chunks=chunk_shape(n_columns),
+            dtype=np.float64
+        )
+        group.create_dataset(f'temperatures_{hdf_name}', data=temps, maxshape=(None,), dtype=np.float64)
+        # usecols drops the empty column produced by the trailing comma of every row
+        reader = pd.read_csv(file, sep=',', header=None, usecols=range(n_columns), dtype=np.float64,
+                             chunksize=rows_per_block)
+        hasher = map_hasher()
+        for block in reader:
+            block = block.to_numpy()
+            hash_update(hasher, block)
+            start = data.shape[0]
+            data.resize(start + len(block), axis=0)
+            data[start:] = block
+            if progress is not None:
+                progress(min(file.buffer.tell() / file_size, 1.0))
+        data.attrs['source_hash'] = finish_map_hash(hasher, data.shape, temps)
+        # whatever the parser left unread still belongs to the file hash
+        for _ in iter(lambda: file.buffer.read(1024 ** 2), b''):
+            pass
+    record_source(data, file_path, file_hasher.hexdigest())
+    return data
+
+
+def hash_file(file_path, block_bytes=1024 ** 2):
+    hasher = blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_bytes), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def record_source(data, file_path, file_hash=None):
+    """Stores size, modification time and content hash of the export a map was converted from. The file is only read
+    again if file_hash is not given."""
+    status = stat(file_path)
+    data.attrs['source_size'] = status.st_size
+    data.attrs['source_mtime'] = status.st_mtime_ns
+    data.attrs['source_file_hash'] = hash_file(file_path) if file_hash is None else file_hash
+
+
+def matches_source(hdf_file_path, hdf_name, file_path):
+    """True if hdf_file_path holds hdf_name converted from file_path as it is now. Equal size and modification time
+    are enough and the export is not read; only if the time differs (e.g. the export was copied) the content hash
+    decides and the stored time is updated."""
+    if not path.exists(hdf_file_path):
+        return False
+    status = stat(file_path)
+    try:
+        with h5py.File(hdf_file_path, 'r+') as hdf_file:
+            data = hdf_file.get(f'{hdf_name}/data_{hdf_name}')
+            if data is None or data.attrs.get('source_size') != status.st_size:
+                return False
+            if data.attrs.get('source_mtime') == status.st_mtime_ns:
+                return True
+            if data.attrs.get('source_file_hash') != hash_file(file_path):
+                return False
+            data.attrs['source_mtime'] = status.st_mtime_ns
+            return True
+    except OSError:
+        # unreadable, e.g. left behind by an interrupted conversion
+        return False
+
+
+@profiled('creation.new')
+def new(file_path, hdf_name, contiguous=False, progress=None, reuse=True):
+    """Converts the export at file_path to hdf_name.hdf5 next to it. With reuse, an existing conversion of the
+    unchanged export is opened instead, keeping its cached derived results."""
+    file_directory = path.split(file_path)[0]
+    hdf_file_path = path.join(file_directory, hdf_name + '.hdf5')
+    if not (reuse and matches_source(hdf_file_path, hdf_name, file_path)):
+        with h5py.File(hdf_file_path, 'w') as hdf_file:
+            group = hdf_file.create_group(hdf_name)
+            write_export(file_path, group, hdf_name, progress=progress)
 
     from thermmap_object import ThermMap
-    return ThermMap(hdf_file_path)
+    thermmap = ThermMap(hdf_file_path, hdf_name)
+    if contiguous and thermmap.dataset.chunks is not None:
+        thermmap.make_contiguous()
+    return thermmap
+
+
+def open_thermmap(file_path, progress=None):
+    """Opens a converted .hdf5 map directly, any other file is treated as a spectrometer export."""
+    if file_path.endswith('.hdf5'):
+        from thermmap_object import ThermMap
+        return ThermMap(file_path)
+    return new(file_path, path.splitext(path.basename(file_path))[0], progress=progress)
@@ -0,0 +1,124 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import json
+from hashlib import blake2b
+from threading import RLock
+from time import time
+
+import numpy as np
+
+default_max_bytes = 512 * 1024 ** 2
+
+
+def hash_update(hasher, array):
+    hasher.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+
+
+def map_hasher():
+    return blake2b(digest_size=16)
+
+
+def finish_map_hash(hasher, shape, temperatures):
+    hash_update(hasher, temperatures)
+    hasher.update(repr(tuple(shape)).encode())
+    return hasher.hexdigest()
+
+
+def hash_map(dataset, temperatures, rows_per_block=8192):
+    """Hash of the raw map, fed row block by row block in the same way the ingest does while streaming."""
+    hasher = map_hasher()
+    for start in range(0, dataset.shape[0], rows_per_block):
+        hash_update(hasher, dataset[start:start + rows_per_block])
+    return finish_map_hash(hasher, dataset.shape, temperatures)
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    return value
+
+
+class DerivedCache:
+    """Results derived from a map, stored in a subgroup of the map's HDF5 group. Every entry is keyed by the operation,
+    its parameters and the hash of the raw data, so entries computed from other data never match. Least recently
+    used entries are evicted once the cache grows over max_bytes (HDF5 reuses the freed space only after repacking).
+    Fits and error determinations write the cache from worker threads, so every access holds a lock shared by all
+    caches; h5py serializes its calls anyway, and an entry is never seen half written."""
+    lock = RLock()
+
+    def __init__(self, map_group, source_hash, max_bytes=default_max_bytes):
+        name = f'derived_{map_group.name.strip("/").split("/")[-1]}'
+        self.source_hash = source_hash
+        self.max_bytes = max_bytes
+        with self.lock:
+            self.group = map_group.require_group(name)
+            if self.group.attrs.get('source_hash', source_hash) != source_hash:
+                self.invalidate()
+            self.group.attrs['source_hash'] = source_hash
+
+    def key(self, operation, parameters):
+        description = json.dumps([operation, _jsonable(parameters), self.source_hash], sort_keys=True)
+        return blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def get(self, operation, parameters):
+        with self.lock:
+            entry = self.group.get(self.key(operation, parameters))
+            if entry is None:
+                return None
+            entry.attrs['last_access'] = time()
+            return {name: dataset[()] for name, dataset in entry.items()}
+
+    def put(self, operation, parameters, **arrays):
+        key = self.key(operation, parameters)
+        with self.lock:
+            if key in self.group:
+                del self.group[key]
+            entry = self.group.create_group(key)
+            entry.attrs['operation'] = operation
+            entry.attrs['parameters'] = json.dumps(_jsonable(parameters), sort_keys=True)
+            entry.attrs['source_hash'] = self.source_hash
+            entry.attrs['last_access'] = time()
+            nbytes = 0
+            for name, array in arrays.items():
+                nbytes += entry.create_dataset(name, data=np.asarray(array)).nbytes
+            entry.attrs['nbytes'] = nbytes
+            self.evict()
+
+    def entries(self, operation=None):
+        with self.lock:
+            return [entry for entry in self.group.values() if operation is None or entry.attrs['operation'] == operation]
+
+    def size(self):
+        with self.lock:
+            return sum(int(entry.attrs['nbytes']) for entry in self.group.values())
+
+    def evict(self):
+        with self.lock:
+            entries = sorted(self.group.values(), key=lambda entry: entry.attrs['last_access'])
+            total = sum(int(entry.attrs['nbytes']) for entry in entries)
+            for entry in entries:
+                if total <= self.max_bytes:
+                    break
+                total -= int(entry.attrs['nbytes'])
+                del self.group[entry.name.split('/')[-1]]
+
+    def invalidate(self, operation=None):
+        with self.lock:
+            for entry in self.entries(operation):
+                del self.group[entry.name.split('/')[-1]]
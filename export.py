@@ -0,0 +1,188 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import json
+from os import path
+
+import h5py
+import numpy as np
+
+from profiling import profiled
+
+csv_rows_per_block = 8192
+export_formats = {'.csv': 'csv', '.txt': 'csv', '.dat': 'csv', '.hdf5': 'hdf5', '.h5': 'hdf5', '.npz': 'npz',
+                  '.parquet': 'parquet'}
+
+
+def csv_columns(analysis):
+    """(header, values) of every column of the text export. Columns have different lengths, scalars become a
+    single row."""
+    thermmap = analysis.thermmap
+    parameter_name = f'Parameter {analysis.first_line_position} nm / {analysis.second_line_position} nm'
+    if analysis.band_widths is not None:
+        first, second = (f'{start}-{end}' if end > start else f'{start}' for start, end in analysis.bands())
+        parameter_name = f'Parameter {first} nm / {second} nm'
+    columns = [('Wavlengths / nm', thermmap.data[:, 0])]
+    for index, temperature in enumerate(thermmap.temperatures):
+        columns.append((f'Intensity {temperature} K / cps', thermmap.data[:, index + 1]))
+    columns += [
+        ('Temperature / K', thermmap.temperatures),
+        (parameter_name, analysis.thermometric_parameter),
+        ('Fit temperature / K', analysis.fit_x),
+        ('Fitted parameter', analysis.fitted_output_data),
+        ('Relative sensitivity / %K^(-1)', analysis.sensitivity),
+        ('Relative sensitivity error / %K^(-1)', analysis.sensitivity_err)
+    ]
+    monte_carlo = analysis.monte_carlo_result
+    if analysis.temperature_err is not None or monte_carlo is not None:
+        columns.append(('Error temperature / K', thermmap.temperatures))
+    if analysis.temperature_err is not None:
+        columns.append(('Temperature error / K', analysis.temperature_err))
+    if monte_carlo is not None:
+        lower, upper = monte_carlo.temperature_interval()
+        columns += [
+            ('Monte Carlo temperature error / K', monte_carlo.temperature_uncertainty),
+            ('Monte Carlo temperature error 2.5% / K', lower),
+            ('Monte Carlo temperature error 97.5% / K', upper)
+        ]
+        for name, (lower, upper) in (('Fitted parameter', monte_carlo.calibration_band()),
+                                     ('Relative sensitivity', monte_carlo.sensitivity_band())):
+            columns += [(f'{name} 2.5%', lower), (f'{name} 97.5%', upper)]
+    for index, fitted_parameter in enumerate(analysis.parameter_names()):
+        columns.append((f'Fitted parameter {fitted_parameter}', analysis.fitted_output_parameters[index]))
+        columns.append((f'Parameter error {fitted_parameter}', analysis.parameter_errors[index]))
+        if analysis.multi_start is not None:
+            columns.append((f'Parameter spread {fitted_parameter}', analysis.multi_start.spread[index]))
+    return [(header, np.atleast_1d(values)) for header, values in columns if values is not None]
+
+
+def write_csv(columns, file_path, rows_per_block=csv_rows_per_block):
+    """Writes ragged columns block by block, leaving the cells past the end of a column empty, so no padded copy of
+    the whole table is ever built."""
+    number_of_rows = max(len(values) for _, values in columns)
+    with open(file_path, 'w', newline='') as file:
+        file.write(','.join(header if ',' not in header else f'"{header}"' for header, _ in columns) + '\n')
+        for start in range(0, number_of_rows, rows_per_block):
+            stop = min(start + rows_per_block, number_of_rows)
+            cells = []
+            for _, values in columns:
+                # empty cells for NaN, as pandas wrote them
+                block = ['' if value != value else str(value) for value in values[start:stop].tolist()]
+                cells.append(block + [''] * (stop - start - len(block)))
+            file.write('\n'.join(','.join(row) for row in zip(*cells)) + '\n')
+    return file_path
+
+
+def result_datasets(analysis):
+    """Results as typed arrays keyed by 'group/name'. The spectra are a view of the map data, not a copy."""
+    thermmap = analysis.thermmap
+    datasets = {
+        'spectra/wavelengths': thermmap.data[:, 0],
+        'spectra/temperatures': thermmap.temperatures,
+        'spectra/intensities': thermmap.data[:, 1:],
+        'calibration/temperatures': thermmap.temperatures,
+        'calibration/parameter': analysis.thermometric_parameter,
+        'curve/temperatures': analysis.fit_x,
+        'curve/fitted_parameter': analysis.fitted_output_data,
+        'curve/relative_sensitivity': analysis.sensitivity,
+        'curve/relative_sensitivity_error': analysis.sensitivity_err,
+        'calibration/relative_sensitivity': analysis.discontinuous_sensitivity,
+        'calibration/relative_sensitivity_error': analysis.discontinuous_sensitivity_err,
+        'calibration/temperature_error': analysis.temperature_err,
+        'fit/parameters': analysis.fitted_output_parameters,
+        'fit/errors': analysis.parameter_errors,
+        'fit/covariance': analysis.covariance
+    }
+    if analysis.multi_start is not None:
+        datasets['fit/spread'] = analysis.multi_start.spread
+    monte_carlo = analysis.monte_carlo_result
+    if monte_carlo is not None:
+        datasets['monte_carlo/parameters'] = monte_carlo.parameters
+        datasets['monte_carlo/temperature_errors'] = monte_carlo.temperature_errors
+        datasets['calibration/monte_carlo_temperature_error'] = monte_carlo.temperature_uncertainty
+        for name, (lower, upper) in (('fitted_parameter', monte_carlo.calibration_band()),
+                                     ('relative_sensitivity', monte_carlo.sensitivity_band())):
+            datasets[f'curve/{name}_lower'] = lower
+            datasets[f'curve/{name}_upper'] = upper
+    return {name: np.asarray(values) for name, values in datasets.items() if values is not None}
+
+
+def result_metadata(analysis):
+    metadata = {
+        'model': analysis.model,
+        'parameter_names': analysis.parameter_names(),
+        'first_line_position': float(analysis.first_line_position),
+        'second_line_position': float(analysis.second_line_position),
+        'map': analysis.thermmap.name
+    }
+    if analysis.band_widths is not None:
+        metadata['band_widths'] = [float(width) for width in analysis.band_widths]
+    return metadata
+
+
+def write_hdf5(analysis, file_path):
+    with h5py.File(file_path, 'w') as file:
+        for name, values in result_datasets(analysis).items():
+            file.create_dataset(name, data=values)
+        for key, value in result_metadata(analysis).items():
+            file.attrs[key] = value
+    return file_path
+
+
+def write_npz(analysis, file_path):
+    """Uncompressed .npz, arrays are keyed by 'group/name'. The metadata is a JSON string under 'metadata'."""
+    np.savez(file_path, metadata=np.array(json.dumps(result_metadata(analysis))), **result_datasets(analysis))
+    return file_path
+
+
+def write_parquet(analysis, file_path):
+    """One Parquet file per group of equally long arrays, named <file>_<group>.parquet next to file_path. Needs
+    pyarrow; the spectra table has a column per temperature."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet export needs pyarrow, install it with "pip install pyarrow"') from None
+    metadata = {'thermlum': json.dumps(result_metadata(analysis))}
+    tables = {}
+    for name, values in result_datasets(analysis).items():
+        group, column = name.split('/')
+        if name == 'spectra/intensities':
+            for index, temperature in enumerate(analysis.thermmap.temperatures):
+                tables.setdefault(group, {})[f'{temperature} K'] = values[:, index]
+        elif values.ndim == 1 and name != 'spectra/temperatures':
+            tables.setdefault(group, {})[column] = values
+    stem = path.splitext(file_path)[0]
+    file_paths = []
+    for group, columns in tables.items():
+        table = pa.table(columns).replace_schema_metadata(metadata)
+        file_paths.append(f'{stem}_{group}.parquet')
+        pq.write_table(table, file_paths[-1])
+    return file_paths
+
+
+@profiled('export.export')
+def export(analysis, file_path, export_format=None):
+    """Writes the results in the format given by export_format or, without it, by the file extension."""
+    if export_format is None:
+        export_format = export_formats.get(path.splitext(file_path)[1].lower(), 'csv')
+    if analysis.thermmap.data is None:
+        analysis.thermmap.get_data()
+    if export_format == 'csv':
+        return write_csv(csv_columns(analysis), file_path)
+    if export_format == 'hdf5':
+        return write_hdf5(analysis, file_path)
+    if export_format == 'npz':
+        return write_npz(analysis, file_path)
+    if export_format == 'parquet':
+        return write_parquet(analysis, file_path)
+    raise ValueError(f'Unknown export format {export_format!r}')
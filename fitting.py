@@ -0,0 +1,127 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.optimize import curve_fit
+from scipy.stats import qmc
+
+from fitting_functions import dict_of_fitting_functions, dict_of_fitting_jacobians, dict_of_fitting_limits
+from profiling import profiled
+
+log_sampling_minimum = 1e-3  # lower end of the log-uniform start range of parameters bounded below by 0
+
+
+class ReducedModel:
+    """Model with fixed parameters removed from the argument list, so the optimizer only sees the free ones."""
+    def __init__(self, model, fixed_parameters):
+        self.function = dict_of_fitting_functions[model]
+        self.jacobian_function = dict_of_fitting_jacobians[model]
+        self.fixed_parameters = list(fixed_parameters)
+        self.free = np.array([value is None for value in self.fixed_parameters])
+
+    def full_parameters(self, free_parameters):
+        free_parameters = iter(free_parameters)
+        return [next(free_parameters) if value is None else value for value in self.fixed_parameters]
+
+    def __call__(self, x, *free_parameters):
+        return self.function(x, *self.full_parameters(free_parameters))
+
+    def jacobian(self, x, *free_parameters):
+        return self.jacobian_function(x, *self.full_parameters(free_parameters))[:, self.free]
+
+
+@profiled('fitting.fit_model')
+def fit_model(model, temperatures, parameter, initial_parameters, fixed_parameters=None):
+    """Returns full parameter vector, full covariance (zero rows and columns for fixed parameters) and the sum of
+    squared residuals. fixed_parameters holds a value for every fixed parameter and None for every free one."""
+    if fixed_parameters is None:
+        fixed_parameters = [None] * len(initial_parameters)
+    reduced_model = ReducedModel(model, fixed_parameters)
+    free = reduced_model.free
+    lower_bounds, upper_bounds = (np.asarray(limits, dtype=np.float64)[free] for limits in dict_of_fitting_limits[model])
+    parameters = np.array([value if fixed is None else fixed for value, fixed in zip(initial_parameters, fixed_parameters)],
+                          dtype=np.float64)
+    covariance = np.zeros((len(parameters), len(parameters)))
+    if free.any():
+        free_parameters, free_covariance = curve_fit(
+            f=reduced_model,
+            xdata=temperatures,
+            ydata=parameter,
+            p0=np.clip(parameters[free], lower_bounds, upper_bounds),
+            bounds=(lower_bounds, upper_bounds),
+            jac=reduced_model.jacobian
+        )
+        parameters[free] = free_parameters
+        covariance[np.ix_(free, free)] = free_covariance
+    residual = parameter - dict_of_fitting_functions[model](temperatures, *parameters)
+    return parameters, covariance, float(np.sum(residual**2))
+
+
+def latin_hypercube_starts(model, number_of_starts, seed=None):
+    """Starting points spread over dict_of_fitting_limits. Parameters bounded below by 0 are sampled log-uniformly,
+    as they typically span orders of magnitude."""
+    lower_bounds, upper_bounds = (np.asarray(limits, dtype=np.float64) for limits in dict_of_fitting_limits[model])
+    sample = qmc.LatinHypercube(d=len(lower_bounds), seed=seed).random(number_of_starts)
+    logarithmic = lower_bounds >= 0
+    low = np.where(logarithmic, np.log10(np.maximum(lower_bounds, log_sampling_minimum)), lower_bounds)
+    high = np.where(logarithmic, np.log10(upper_bounds), upper_bounds)
+    starts = low + sample * (high - low)
+    starts[:, logarithmic] = 10**starts[:, logarithmic]
+    return starts
+
+
+def _fit_start(model, temperatures, parameter, initial_parameters, fixed_parameters):
+    try:
+        return fit_model(model, temperatures, parameter, initial_parameters, fixed_parameters)
+    except (RuntimeError, ValueError):
+        return None
+
+
+class MultiStartResult:
+    def __init__(self, parameters, covariance, cost, solutions, costs):
+        self.parameters = parameters
+        self.covariance = covariance
+        self.cost = cost
+        self.solutions = solutions
+        self.costs = costs
+
+    @property
+    def spread(self):
+        return np.std(self.solutions, axis=0)
+
+    def near_best(self, relative_tolerance=0.05):
+        """Solutions whose cost is within relative_tolerance of the best one."""
+        return self.solutions[self.costs <= self.cost * (1 + relative_tolerance)]
+
+
+@profiled('fitting.multi_start_fit')
+def multi_start_fit(model, temperatures, parameter, initial_parameters, fixed_parameters=None, number_of_starts=16,
+                    workers=None, seed=None):
+    """Fits from the given starting point and from Latin hypercube starting points in parallel, keeping the best fit."""
+    if fixed_parameters is None:
+        fixed_parameters = [None] * len(initial_parameters)
+    starts = [list(initial_parameters)] + latin_hypercube_starts(model, number_of_starts - 1, seed).tolist()
+    arguments = [(model, temperatures, parameter, start, fixed_parameters) for start in starts]
+    if workers == 1:
+        fits = [_fit_start(*argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fits = list(executor.map(_fit_start, *zip(*arguments)))
+    fits = [fit for fit in fits if fit is not None]
+    if not fits:
+        raise RuntimeError(f'None of the {number_of_starts} starting points converged')
+    solutions = np.array([fit[0] for fit in fits])
+    costs = np.array([fit[2] for fit in fits])
+    best = int(np.argmin(costs))
+    return MultiStartResult(solutions[best], fits[best][1], costs[best], solutions, costs)
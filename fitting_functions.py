@@ -10,14 +10,36 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
-from numpy import exp, tanh, sqrt, cosh, sinh
+from numpy import exp, tanh, sqrt, cosh, sinh, minimum, column_stack, ones_like, asarray, float64
 
 boltzmann_constant_J_K = 1 # values of energy in K
 parameters_limit = 1e4
+max_exponent = 709.0  # exp(709) is close to the largest float64
+
+
+def boltzmann_factor(x, e):
+    # clipping the exponent keeps exp(-e/kT) finite for negative energies at low temperatures
+    return exp(minimum(-e / (boltzmann_constant_J_K * x), max_exponent))
 
 
 def single_mott_seitz(x, delta0, a1, e1):
-    return delta0 / (1 + a1 * exp(-e1 / (boltzmann_constant_J_K * x)))
+    return delta0 / (1 + a1 * boltzmann_factor(x, e1))
+
+
+def single_mott_seitz_jacobian(x, delta0, a1, e1):
+    x = asarray(x, dtype=float64)
+    b1 = boltzmann_factor(x, e1)
+    denominator = 1 + a1 * b1
+    return column_stack((
+        1 / denominator,
+        -delta0 * b1 / denominator**2,
+        delta0 * a1 * b1 / (boltzmann_constant_J_K * x * denominator**2)
+    ))
+
+
+def single_mott_seitz_dx(x, delta0, a1, e1):
+    b1 = boltzmann_factor(x, e1)
+    return -delta0 * a1 * b1 * e1 / (boltzmann_constant_J_K * x**2 * (1 + a1 * b1)**2)
 
 
 def single_mott_seitz_error(x, delta0, a1, e1, delta0_error, a1_error, e1_error):
@@ -25,7 +47,27 @@ def single_mott_seitz_error(x, delta0, a1, e1, delta0_error, a1_error, e1_error)
 
 
 def double_mott_seitz(x, delta0, a1, a2, e1, e2):
-    return delta0 / (1 + a1 * exp(-e1 / (boltzmann_constant_J_K * x) + (1 + a2 * exp(-e2 / (boltzmann_constant_J_K * x)))))
+    return delta0 / (1 + a1 * boltzmann_factor(x, e1) + a2 * boltzmann_factor(x, e2))
+
+
+def double_mott_seitz_jacobian(x, delta0, a1, a2, e1, e2):
+    x = asarray(x, dtype=float64)
+    b1 = boltzmann_factor(x, e1)
+    b2 = boltzmann_factor(x, e2)
+    denominator_squared = (1 + a1 * b1 + a2 * b2)**2
+    return column_stack((
+        1 / (1 + a1 * b1 + a2 * b2),
+        -delta0 * b1 / denominator_squared,
+        -delta0 * b2 / denominator_squared,
+        delta0 * a1 * b1 / (boltzmann_constant_J_K * x * denominator_squared),
+        delta0 * a2 * b2 / (boltzmann_constant_J_K * x * denominator_squared)
+    ))
+
+
+def double_mott_seitz_dx(x, delta0, a1, a2, e1, e2):
+    b1 = boltzmann_factor(x, e1)
+    b2 = boltzmann_factor(x, e2)
+    return -delta0 * (a1 * b1 * e1 + a2 * b2 * e2) / (boltzmann_constant_J_K * x**2 * (1 + a1 * b1 + a2 * b2)**2)
 
 
 def double_mott_seitz_error(x, delta0, a1, a2, e1, e2, delta0_error, a1_error, a2_error, e1_error, e2_error):
@@ -40,12 +82,31 @@ def double_mott_seitz_error(x, delta0, a1, a2, e1, e2, delta0_error, a1_error, a
 def linear(x, a, b):
     return a * x + b
 
+
+def linear_jacobian(x, a, b):
+    x = asarray(x, dtype=float64)
+    return column_stack((x, ones_like(x)))
+
+def linear_dx(x, a, b):
+    return a * ones_like(asarray(x, dtype=float64))
+
+
 def linear_error(x, a, b, a_error, b_error):
     return sqrt(a_error**2 * x**2 + b_error**2)
 
 
 def exponential_decay(x, b, e1):
-    return b * exp(-e1 / (boltzmann_constant_J_K * x))
+    return b * boltzmann_factor(x, e1)
+
+
+def exponential_decay_jacobian(x, b, e1):
+    x = asarray(x, dtype=float64)
+    b1 = boltzmann_factor(x, e1)
+    return column_stack((b1, -b * b1 / (boltzmann_constant_J_K * x)))
+
+
+def exponential_decay_dx(x, b, e1):
+    return b * boltzmann_factor(x, e1) * e1 / (boltzmann_constant_J_K * x**2)
 
 
 def exponential_decay_error(x, b, e1, b_error, e1_error):
@@ -56,6 +117,23 @@ def exponential_decay_error(x, b, e1, b_error, e1_error):
 def coth_vibration(x, delta0, ev, b):
     return delta0 / ((1 / tanh(ev / (2 * x))) + b)
 
+
+def coth_vibration_jacobian(x, delta0, ev, b):
+    x = asarray(x, dtype=float64)
+    coth = 1 / tanh(ev / (2 * x))
+    denominator = coth + b
+    # d coth(u)/du = 1 - coth(u)^2, written without sinh which overflows for large ev/T
+    return column_stack((
+        1 / denominator,
+        delta0 * (coth**2 - 1) / (2 * x * denominator**2),
+        -delta0 / denominator**2
+    ))
+
+def coth_vibration_dx(x, delta0, ev, b):
+    coth = 1 / tanh(ev / (2 * x))
+    return -delta0 * (coth**2 - 1) * ev / (2 * x**2 * (coth + b)**2)
+
+
 def coth_vibration_error(x, delta0, ev, b, delta0_error, ev_error, b_error):
     return sqrt(delta0_error**2 * (1 / (1 / tanh(ev / (2 * x)) + b))**2 +
                 ev_error**2 * ((delta0 / (2 * x * (b * sinh(ev / (2 * x)) + cosh(ev / 2 * x)**2))))**2 +
@@ -70,6 +148,22 @@ dict_of_fitting_functions = {
     'coth': coth_vibration
 }
 
+dict_of_fitting_jacobians = {
+    'Single Mott-Seitz': single_mott_seitz_jacobian,
+    'Double Mott-Seitz': double_mott_seitz_jacobian,
+    'Linear': linear_jacobian,
+    'Exponential decay': exponential_decay_jacobian,
+    'coth': coth_vibration_jacobian
+}
+
+dict_of_temperature_derivatives = {
+    'Single Mott-Seitz': single_mott_seitz_dx,
+    'Double Mott-Seitz': double_mott_seitz_dx,
+    'Linear': linear_dx,
+    'Exponential decay': exponential_decay_dx,
+    'coth': coth_vibration_dx
+}
+
 dict_of_fitting_limits = {
     'Single Mott-Seitz': [[-parameters_limit, 0, 0], [parameters_limit, parameters_limit, parameters_limit]],
     'Double Mott-Seitz': [[-parameters_limit, 0, 0, 0, 0], [parameters_limit, parameters_limit, parameters_limit, parameters_limit, parameters_limit]],
@@ -15,24 +15,28 @@ from sys import argv
 import json
 from inspect import signature
 from functools import partial
-from scipy.optimize import curve_fit
-from numpy import linspace, float64, gradient, sum, sqrt, diag, isclose, array
-from pandas import DataFrame, Series
+from time import perf_counter
+from numpy import float64, sum
 
 from PyQt6.QtWidgets import QDialog, QSpinBox, QDialogButtonBox, QLabel, QWidget, QVBoxLayout, \
     QApplication, QMainWindow, QFileDialog, QHBoxLayout, QGridLayout, QAbstractSpinBox, QComboBox, \
-    QFormLayout, QDoubleSpinBox, QPushButton, QStackedLayout, QSizePolicy
+    QFormLayout, QDoubleSpinBox, QPushButton, QStackedLayout, QSizePolicy, QMessageBox, QCheckBox, QTableWidget, \
+    QTableWidgetItem
 from PyQt6.QtGui import QIcon
+from PyQt6.QtCore import QTimer
 
 import matplotlib as mpl  # import matplotlib after PyQt6
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from matplotlib.backends.backend_qtagg import (NavigationToolbar2QT as NavigationToolbar)
 from matplotlib.figure import Figure
 
-from creation import new
 from utilities import quantization_to_resolution
-from plotting import luminescence_dt
+from plotting import SpectraPlot, MarkerOverlay
+from lod import SpectralPyramid
 from fitting_functions import dict_of_fitting_functions, dict_of_fitting_limits
+from tasks import TaskRunner, TaskCancelled
+import profiling
+from profiling import profiled
 
 mpl.use("QtAgg")
 
@@ -40,6 +44,30 @@ with open('./settings.json', 'r') as settings_json:
     settings = json.load(settings_json)
 
 
+def load_thermmap(file_path, progress=None):
+    # pandas and h5py are only imported once a map is opened, keeping them off the startup path
+    from creation import open_thermmap
+    thermmap = open_thermmap(file_path, progress=progress)
+    thermmap.get_data()
+    thermmap.get_temperatures()
+    return thermmap, thermmap.pyramid()
+
+
+def spectra_colormap(number_of_temperatures):
+    return mpl.colors.LinearSegmentedColormap.from_list(
+        name='',
+        colors=settings["plot_colormap"],
+        N=number_of_temperatures
+    )
+
+
+marker_styles = {
+    'first': dict(ymin=0.02, ymax=0.9, linestyle='--', color='#6D597A', picker=True, zorder=0),
+    'second': dict(ymin=0.02, ymax=0.9, linestyle='--', color='#E56B6F', picker=True, zorder=0),
+    'normalization': dict(ymin=0, ymax=1, linestyle='-', color='#ffd656', picker=True, zorder=0)
+}
+
+
 class MplCanvas(FigureCanvasQTAgg):
     def __init__(self, parent=None, width=settings['plot_width'], height=settings['plot_height'],
                  dpi=settings['plot_dpi']):
@@ -48,6 +76,10 @@ class MplCanvas(FigureCanvasQTAgg):
         self.axes = fig.add_subplot(111)
         super(MplCanvas, self).__init__(fig)
 
+    @profiled('MplCanvas.draw')
+    def draw(self):
+        super(MplCanvas, self).draw()
+
 
 class OutMplCanvas(FigureCanvasQTAgg):
     def __init__(self, parent=None, width=settings['plot_width'], height=settings['plot_height'],
@@ -63,6 +95,10 @@ class OutMplCanvas(FigureCanvasQTAgg):
         self.error_axes.sharex(self.parameter_axes)
         super(OutMplCanvas, self).__init__(fig)
 
+    @profiled('OutMplCanvas.draw')
+    def draw(self):
+        super(OutMplCanvas, self).draw()
+
 
 class NumberedSciDSpinBox(QDoubleSpinBox):
     def __init__(self, *args, index, **kwargs):
@@ -89,13 +125,74 @@ class NumberedPushButton(QPushButton):
         super().__init__(*args, **kwargs)
 
 
+class ProfilingDialog(QDialog):
+    """Aggregated timings of the instrumented steps, see profiling.py."""
+    columns = ['name', 'calls', 'total', 'mean', 'max']
+
+    def __init__(self, parent=None):
+        super(ProfilingDialog, self).__init__(parent)
+        self.setWindowTitle('Profiling')
+        self.setWindowIcon(QIcon(r'.\icon\app_icon.tiff'))
+        self.setMinimumWidth(600)
+        layout = QVBoxLayout()
+
+        self.enabled_widget = QCheckBox('Record timings')
+        self.enabled_widget.setChecked(profiling.enabled)
+        self.enabled_widget.toggled.connect(profiling.enable)
+        layout.addWidget(self.enabled_widget)
+
+        self.table = QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(['Step', 'Calls', 'Total / ms', 'Mean / ms', 'Max / ms'])
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.table)
+
+        buttons = QHBoxLayout()
+        for label, slot in (('Refresh', self.refresh), ('Reset', self.reset), ('Save JSON', self.save),
+                            ('cProfile next action', self.profile_next)):
+            button = QPushButton(label)
+            button.clicked.connect(slot)
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.refresh()
+
+    def refresh(self):
+        rows = profiling.summary()
+        self.table.setRowCount(len(rows))
+        for row_index, row in enumerate(rows):
+            for column_index, column in enumerate(self.columns):
+                value = row[column]
+                if column in ('total', 'mean', 'max'):
+                    value = f'{value * 1e3:.2f}'
+                self.table.setItem(row_index, column_index, QTableWidgetItem(str(value)))
+        self.table.resizeColumnsToContents()
+
+    def reset(self):
+        profiling.reset()
+        self.refresh()
+
+    def save(self):
+        filename, _ = QFileDialog.getSaveFileName(caption='Save timings', directory=settings['recently_opened_folder'], filter='JSON Files (*.json)')
+        if filename:
+            profiling.dump(filename)
+
+    def profile_next(self):
+        filename, _ = QFileDialog.getSaveFileName(caption='Save cProfile statistics of the next action', directory=settings['recently_opened_folder'], filter='Profile Files (*.prof)')
+        if filename:
+            profiling.profile_next(filename)
+            self.enabled_widget.setChecked(True)
+
+
 class ErrorDeterminingDialog(QDialog):
     def __init__(self, thermmap, parent=None):
         super(ErrorDeterminingDialog, self).__init__(parent)
         self.thermmap = thermmap
+        self.tasks = TaskRunner(self)
 
         self.smoothed_data = None
         self.smoothed_residual = None
+        self.smoothed_plot = None
+        self.residual_plot = None
 
         self.setWindowTitle("Error Determining Method")
         self.setWindowIcon(QIcon(r'.\icon\app_icon.tiff'))
@@ -177,70 +274,70 @@ class ErrorDeterminingDialog(QDialog):
         polyorder = self.polyorder_widget.value()
         if window_length < polyorder:
             self.polyorder_widget.setValue(window_length - 1)
-        self.smoothed_data, self.smoothed_residual = self.thermmap.smooth(
+        # rapid spinbox changes supersede the smoothing still running for the previous values
+        self.tasks.submit(
+            'smooth',
+            self.thermmap.smooth,
             window_length=self.window_length_widget.value(),
             polyorder=self.polyorder_widget.value(),
-            delta=self.step_widget.value()
-        )
-
-        if self.smoothed_data is not None:
-            self.canvas.parameter_axes.clear()
-            self.canvas.error_axes.clear()
-            
-        self.canvas.parameter_axes = luminescence_dt(
-            self.smoothed_data,
-            self.thermmap.temperatures,
-            self.canvas.parameter_axes,
-            colormap=mpl.colors.LinearSegmentedColormap.from_list(
-                        name='',
-                        colors=settings["plot_colormap"],
-                        N=len(self.thermmap.temperatures)
-                    )
-            )
-        
-        self.canvas.error_axes.axhline(
-            y=0,
-            color='#444444', 
-            linestyle='--',
+            delta=self.step_widget.value(),
+            workers=settings.get('smoothing_workers', 1),
+            on_finished=self.on_smoothed,
+            on_failed=lambda error: QMessageBox.warning(self, 'Smoothing failed', f'{type(error).__name__}: {error}'),
+            with_progress=True
         )
 
-        self.canvas.error_axes = luminescence_dt(
-            self.smoothed_residual,
-            self.thermmap.temperatures,
-            self.canvas.error_axes,
-            colormap=mpl.colors.LinearSegmentedColormap.from_list(
-                        name='',
-                        colors=settings["plot_colormap"],
-                        N=len(self.thermmap.temperatures)
-                    )
+    def on_smoothed(self, result):
+        self.smoothed_data, self.smoothed_residual = result
+        if self.smoothed_plot is None:
+            self.smoothed_plot = SpectraPlot(self.canvas.parameter_axes, spectra_colormap(len(self.thermmap.temperatures)))
+            self.canvas.error_axes.axhline(
+                y=0,
+                color='#444444', 
+                linestyle='--',
             )
-        self.canvas.error_axes.set_ylabel('Residual')
-        self.canvas.draw()
+            self.residual_plot = SpectraPlot(self.canvas.error_axes, spectra_colormap(len(self.thermmap.temperatures)))
+            self.canvas.error_axes.set_ylabel('Residual')
+        self.smoothed_plot.set_data(self.smoothed_data, self.thermmap.temperatures)
+        self.residual_plot.set_data(self.smoothed_residual, self.thermmap.temperatures)
+        self.smoothed_plot.draw()
         self.residula_widget.setValue(sum(self.smoothed_residual[:, 1:]))
 
+    def done(self, result):
+        self.tasks.cancel('smooth')
+        super(ErrorDeterminingDialog, self).done(result)
+
 
         
 
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, file_path=None, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
+        self.tasks = TaskRunner(self)
 
-        start_path = path.expanduser(settings['recently_opened_folder'])
+        if file_path is None:
+            start_path = path.expanduser(settings['recently_opened_folder'])
 
-        filters = 'CSV Files (*.csv);;Text Files (*.txt);;Data Files (*.dat)'
-        selectedFilter = settings['default_file_type']
+            filters = 'CSV Files (*.csv);;Text Files (*.txt);;Data Files (*.dat);;HDF5 Files (*.hdf5)'
+            selectedFilter = settings['default_file_type']
 
-        file_path, filter = QFileDialog.getOpenFileName(
-            None, "Choose a filename", start_path,
-            filters, selectedFilter)
+            file_path, filter = QFileDialog.getOpenFileName(
+                None, "Choose a filename", start_path,
+                filters, selectedFilter)
+        if not file_path:
+            raise TaskCancelled()
 
         settings['recently_opened_folder'] = path.split(file_path)[0]
 
-        self.thermmap = new(file_path, path.split(file_path)[1][:-4])
-        self.thermmap.get_data()
-        self.thermmap.get_temperatures()
+        self.thermmap, pyramid = self.tasks.run_with_progress(
+            'ingest',
+            f'Opening {path.split(file_path)[1]}',
+            load_thermmap,
+            file_path,
+            with_progress=True
+        )
 
         self.canvas = MplCanvas(self)
         self.canvas.setSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Minimum)
@@ -252,31 +349,23 @@ class MainWindow(QMainWindow):
         self.fitting_canvas = None
         self.fitting_toolbar = None
 
-        self.canvas.axes = luminescence_dt(
-            self.thermmap.data,
-            self.thermmap.temperatures,
-            self.canvas.axes,
-            colormap=mpl.colors.LinearSegmentedColormap.from_list(
-                name='',
-                colors=settings["plot_colormap"],
-                N=len(self.thermmap.temperatures))
-        )
+        self.spectra_plot = SpectraPlot(self.canvas.axes, spectra_colormap(len(self.thermmap.temperatures)))
+        self.spectra_plot.set_pyramid(pyramid, self.thermmap.temperatures)
+        self.normalized_spectra_plot = SpectraPlot(self.normalized_canvas.axes,
+                                                   spectra_colormap(len(self.thermmap.temperatures)))
 
         self.first_click = True
         self.second_click = False
-        self.first_line = None
-        self.second_line = None
-        self.normalized_first_line = None
-        self.normalized_second_line = None
-        self.normalized_normalization_line = None
+        self.markers = MarkerOverlay(self.canvas.axes)
+        self.normalized_markers = MarkerOverlay(self.normalized_canvas.axes)
         self.first_line_position = None
         self.second_line_position = None
         self.normalization_position = None
-        self.normalization_line = None
+        self.analysis = None
         self.fitting_plot = None
         self.sensitivity_plot = None
+        self.sensitivity_band = None
         self.error_bar_plot = None
-        self.temperature_err = None
 
         self.cid1 = self.canvas.mpl_connect('button_press_event', self.on_click)
         self.cid2 = self.canvas.mpl_connect('pick_event', self.on_pick)
@@ -321,6 +410,20 @@ class MainWindow(QMainWindow):
         self.second_value_widget.setMinimumWidth(150)
         self.second_value_widget.valueChanged.connect(self.on_second_value_changed)
         layout_wavelengths_chooser.addRow(QLabel('Denominator: '), self.second_value_widget)
+        self.band_width_widgets = []
+        for label in ('Numerator band: ', 'Denominator band: '):
+            band_width_widget = QDoubleSpinBox(
+                minimum=0.0,
+                maximum=abs(self.thermmap.data[-1, 0] - self.thermmap.data[0, 0]),
+                singleStep=self.thermmap.resolution,
+                suffix=' nm'
+            )
+            band_width_widget.setKeyboardTracking(False)
+            band_width_widget.setMinimumWidth(150)
+            band_width_widget.setToolTip('Width of the window integrated around the line, 0 uses the single wavelength')
+            band_width_widget.valueChanged.connect(self.follow_windows)
+            layout_wavelengths_chooser.addRow(QLabel(label), band_width_widget)
+            self.band_width_widgets.append(band_width_widget)
         layout_ribbon.addLayout(layout_wavelengths_chooser)
 
         layout_normalization_widgets = QGridLayout()
@@ -402,6 +505,16 @@ class MainWindow(QMainWindow):
         layout_ribbon.addWidget(self.fitting_functions_widget)
         layout_ribbon.addLayout(self.fitting_functions_layout)
 
+        layout_starts = QFormLayout()
+        self.number_of_starts_widget = QSpinBox(
+            minimum=1,
+            maximum=1000,
+        )
+        self.number_of_starts_widget.setValue(1)
+        self.number_of_starts_widget.setToolTip('Fits from more than one starting point are run in parallel and the best one is kept')
+        layout_starts.addRow(QLabel('Starting points: '), self.number_of_starts_widget)
+        layout_ribbon.addLayout(layout_starts)
+
         self.start_fitting_button = QPushButton('Start Fitting')
         self.start_fitting_button.clicked.connect(self.start_fitting)
         layout_ribbon.addWidget(self.start_fitting_button)
@@ -421,14 +534,16 @@ class MainWindow(QMainWindow):
         widget = QWidget()
         widget.setLayout(self.layout_main)
         self.setCentralWidget(widget)
-        self.canvas.draw()
+        self.menuBar().addAction('Profiling', lambda: ProfilingDialog(self).show())
+        self.spectra_plot.draw()
+        self.statusBar().showMessage(f'Spectra rendered in {self.spectra_plot.render_time * 1e3:.0f} ms')
         self.move(0, 0)
 
     def on_click(self, event):
         if type(event.button) is str:
             return
         else:
-            value = quantization_to_resolution(event.xdata, self.thermmap.resolution)
+            value = quantization_to_resolution(event.xdata, self.thermmap.resolution, self.thermmap.wavelength_index)
         if event.button == event.button.LEFT:
             if self.first_click:
                 self.first_value_widget.setValue(value)
@@ -442,172 +557,60 @@ class MainWindow(QMainWindow):
     def on_pick(self, event):
         if type(event.mouseevent.button) is str:
             return
-        artist = event.artist
         mouse_event = event.mouseevent
-        if (mouse_event.button == mouse_event.button.RIGHT) and (
-                artist == self.first_line or artist == self.normalized_first_line):
-            if self.normalized_first_line is not None:
-                self.normalized_first_line.remove()
-                self.normalized_first_line = None
-            if self.first_line is not None:
-                self.first_line.remove()
-                self.first_line = None
+        if mouse_event.button != mouse_event.button.RIGHT:
+            return
+        name = self.markers.name_of(event.artist) or self.normalized_markers.name_of(event.artist)
+        if name == 'first':
             self.first_click = True
             self.first_line_position = None
-            self.canvas.draw()
-            self.normalized_canvas.draw()
-        elif (mouse_event.button == mouse_event.button.RIGHT) and (
-                artist == self.second_line or artist == self.normalized_second_line):
-            if self.normalized_second_line is not None:
-                self.normalized_second_line.remove()
-                self.normalized_second_line = None
-            if self.second_line is not None:
-                self.second_line.remove()
-                self.second_line = None
+        elif name == 'second':
             self.second_click = True
             self.second_line_position = None
-            self.canvas.draw()
-            self.normalized_canvas.draw()
+        else:
+            return
+        self.markers.hide(name)
+        self.normalized_markers.hide(name)
+
+    def move_marker(self, name, value):
+        self.markers.move(name, value, **marker_styles[name])
+        self.normalized_markers.move(name, value, **marker_styles[name])
 
     def on_first_value_changed(self, value):
-        new_value = quantization_to_resolution(value, self.thermmap.resolution)
-        if new_value != value:
-            self.first_value_widget.setValue(new_value)
+        if self.thermmap.wavelength_index.find(value) < 0:
+            self.first_value_widget.setValue(quantization_to_resolution(value, self.thermmap.resolution, self.thermmap.wavelength_index))
             return
-        if self.first_line is not None:
-            self.first_line.remove()
-        if self.normalized_first_line is not None:
-            self.normalized_first_line.remove()
-        self.first_line = self.canvas.axes.axvline(
-            value,
-            ymin=0.02,
-            ymax=0.9,
-            linestyle='--',
-            color='#6D597A',
-            picker=True,
-            zorder=0
-        )
-        self.normalized_first_line = self.normalized_canvas.axes.axvline(
-            value,
-            ymin=0.02,
-            ymax=0.9,
-            linestyle='--',
-            color='#6D597A',
-            picker=True,
-            zorder=0
-        )
         self.first_line_position = value
         self.first_click = False
-        self.canvas.draw()
-        self.normalized_canvas.draw()
+        self.move_marker('first', value)
+        self.follow_windows()
 
     def on_second_value_changed(self, value):
-        new_value = quantization_to_resolution(value, self.thermmap.resolution)
-        if new_value != value:
-            self.second_value_widget.setValue(new_value)
+        if self.thermmap.wavelength_index.find(value) < 0:
+            self.second_value_widget.setValue(quantization_to_resolution(value, self.thermmap.resolution, self.thermmap.wavelength_index))
             return
-        if self.second_line is not None:
-            self.second_line.remove()
-        if self.normalized_second_line is not None:
-            self.normalized_second_line.remove()
-        self.second_line = self.canvas.axes.axvline(
-            value,
-            ymin=0.02,
-            ymax=0.9,
-            linestyle='--',
-            color='#E56B6F',
-            picker=True,
-            zorder=0
-        )
-        self.normalized_second_line = self.normalized_canvas.axes.axvline(
-            value,
-            ymin=0.02,
-            ymax=0.9,
-            linestyle='--',
-            color='#E56B6F',
-            picker=True,
-            zorder=0
-        )
         self.second_line_position = value
         self.second_click = False
-        self.canvas.draw()
-        self.normalized_canvas.draw()
+        self.move_marker('second', value)
+        self.follow_windows()
 
     def on_normalization_value_changed(self, value):
-        new_value = quantization_to_resolution(value, self.thermmap.resolution)
-        if new_value != value:
-            self.normalization_value_widget.setValue(new_value)
+        if self.thermmap.wavelength_index.find(value) < 0:
+            self.normalization_value_widget.setValue(quantization_to_resolution(value, self.thermmap.resolution, self.thermmap.wavelength_index))
             return
-        if self.normalization_line is not None:
-            self.normalization_line.remove()
-        if self.normalized_normalization_line is not None:
-            self.normalized_normalization_line.remove()
-        self.normalization_line = self.canvas.axes.axvline(
-            value,
-            ymin=0,
-            ymax=1,
-            linestyle='-',
-            color='#ffd656',
-            picker=True,
-            zorder=0
-        )
-        self.normalized_normalization_line = self.normalized_canvas.axes.axvline(
-            value,
-            ymin=0,
-            ymax=1,
-            linestyle='-',
-            color='#ffd656',
-            picker=True,
-            zorder=0
-        )
         self.normalization_position = value
-        self.canvas.draw()
-        self.normalized_canvas.draw()
+        self.move_marker('normalization', value)
 
     def on_normalization_button_clicked(self, checked):
         if self.normalization_position is not None:
             if checked:
                 self.normalization_button.setText('Denormalize')
-                self.normalized_canvas.axes.cla()
-                self.normalized_canvas.axes = luminescence_dt(
-                    self.thermmap.normalize(self.normalization_position),
-                    self.thermmap.temperatures,
-                    self.normalized_canvas.axes,
-                    colormap=mpl.colors.LinearSegmentedColormap.from_list(
-                        name='',
-                        colors=settings["plot_colormap"],
-                        N=len(self.thermmap.temperatures)
-                    ))
-                if self.first_line_position is not None:
-                    self.normalized_first_line = self.normalized_canvas.axes.axvline(
-                        self.first_line_position,
-                        ymin=0.02,
-                        ymax=0.9,
-                        linestyle='--',
-                        color='#6D597A',
-                        picker=True,
-                        zorder=0
-                    )
-                if self.second_line_position is not None:
-                    self.normalized_second_line = self.normalized_canvas.axes.axvline(
-                        self.second_line_position,
-                        ymin=0.02,
-                        ymax=0.9,
-                        linestyle='--',
-                        color='#E56B6F',
-                        picker=True,
-                        zorder=0
-                    )
-                self.normalized_normalization_line = self.normalized_canvas.axes.axvline(
-                    self.normalization_position,
-                    ymin=0,
-                    ymax=1,
-                    linestyle='-',
-                    color='#ffd656',
-                    picker=True,
-                    zorder=0
+                self.normalized_spectra_plot.set_pyramid(
+                    SpectralPyramid.from_array(self.thermmap.normalize(self.normalization_position, save=True)),
+                    self.thermmap.temperatures
                 )
-                self.normalized_canvas.draw()
+                self.normalized_spectra_plot.draw()
+                self.statusBar().showMessage(f'Normalized spectra rendered in {self.normalized_spectra_plot.render_time * 1e3:.0f} ms')
                 self.layout_plots.setCurrentIndex(1)
             else:
                 self.normalization_button.setText('Normalize')
@@ -616,6 +619,16 @@ class MainWindow(QMainWindow):
             self.normalization_button.setChecked(False)
 
     def create_thermometric_parameter(self):
+        self.show_thermometric_parameter()
+
+    def follow_windows(self, _=None):
+        """Once a thermometric parameter is shown it follows the lines and band widths. Band integrals come from the
+        map's cumulative integral held in memory, so it is recomputed on every change without being cached."""
+        if self.analysis is None or not self.start_fitting_button.isEnabled():
+            return
+        self.show_thermometric_parameter(save=False)
+
+    def show_thermometric_parameter(self, save=True):
         if self.first_line_position is None or self.second_line_position is None:
             return
         if self.fitting_canvas is None:
@@ -627,20 +640,31 @@ class MainWindow(QMainWindow):
             layout_fitting.addWidget(self.fitting_canvas)
             self.layout_main.addLayout(layout_fitting)
 
-        self.thermometric_parameter = self.thermmap.get_row_of_ydata(
-            self.first_line_position) / self.thermmap.get_row_of_ydata(self.second_line_position)
+        from pipeline import Analysis  # pulls in scipy and pandas
+        band_widths = [widget.value() for widget in self.band_width_widgets]
+        self.analysis = Analysis(self.thermmap, self.first_line_position, self.second_line_position, band_widths)
+        self.analysis.create_thermometric_parameter(save)
+        self.fitting_plot = None
+        self.sensitivity_plot = None
+        self.sensitivity_band = None
+        self.error_bar_plot = None
         self.fitting_canvas.parameter_axes.cla()
+        self.fitting_canvas.sensitivity_axes.cla()
+        self.fitting_canvas.error_axes.cla()
         self.fitting_canvas.parameter_axes.scatter(
             self.thermmap.temperatures[...],
-            self.thermometric_parameter[...],
+            self.analysis.thermometric_parameter[...],
             color='#6D597A',
             marker='o',
             facecolors='none'
         )
-        self.fitting_canvas.parameter_axes.set_ylabel('Intensity ratio', color='#6D597A')
+        self.fitting_canvas.parameter_axes.set_ylabel('Intensity ratio' if self.analysis.band_widths is None else
+                                                      'Integrated intensity ratio', color='#6D597A')
         self.fitting_canvas.parameter_axes.tick_params(axis='y', labelcolor='#6D597A')
         self.fitting_canvas.error_axes.set_xlabel('Temperature / K')
         self.fitting_canvas.draw()
+        # the new analysis has not been fitted yet
+        self.set_fitting_enabled(True)
 
     def on_fitting_function_changed(self, index):
         self.fitting_functions_layout.setCurrentIndex(index)
@@ -659,67 +683,64 @@ class MainWindow(QMainWindow):
             return
         
         current_index = self.fitting_functions_layout.currentIndex()
-        fitting_function = list(dict_of_fitting_functions.values())[current_index]
-        current_bounds = self.bounds_on_parameters[current_index]
-        current_initial_parameters = []
-        for value in self.initial_parameters[current_index]:
-            if value is None:
-                current_initial_parameters.append(1.0)
-            else:
-                current_initial_parameters.append(value)
-        for index, block in enumerate(self.blocked_parameters[current_index]):
-            if block and self.initial_parameters[current_index][index] is not None:
-                current_bounds[0][index] = self.initial_parameters[current_index][index]
-                current_bounds[1][index] = self.initial_parameters[current_index][index] + 1e-9
-            elif not block and self.initial_parameters[current_index][index] is not None:
-                current_bounds[0][index] = self.bounds_on_parameters[current_index][0][index]
-                current_bounds[1][index] = self.bounds_on_parameters[current_index][1][index]
-
-        self.fitted_output_parameters, covariance = curve_fit(
-            f=fitting_function,
-            xdata=self.thermmap.temperatures,
-            ydata=self.thermometric_parameter,
-            p0=current_initial_parameters,
-            bounds=current_bounds
+        self.set_fitting_enabled(False)
+        self.tasks.submit(
+            'fit',
+            self.analysis.fit,
+            self.fitting_functions_widget.currentText(),
+            initial_parameters=self.initial_parameters[current_index],
+            blocked_parameters=self.blocked_parameters[current_index],
+            number_of_starts=self.number_of_starts_widget.value(),
+            workers=settings.get('fitting_workers', None),
+            on_finished=partial(self.on_fitted, current_index=current_index),
+            on_failed=partial(self.on_task_failed, 'Fitting failed')
         )
 
-        self.parameter_errors = sqrt(diag(covariance))
-
-        for index, parameter in enumerate(self.fitted_output_parameters):
+    def set_fitting_enabled(self, enabled):
+        # fitting and error determination write to the map's derived cache, which an export must not race with
+        fitted = self.analysis is not None and self.analysis.fitted_output_parameters is not None
+        self.create_thermometric_parameter_button.setEnabled(enabled)
+        self.start_fitting_button.setEnabled(enabled)
+        self.start_fitting_button.setText('Start Fitting' if enabled else 'Fitting...')
+        self.determine_error_button.setEnabled(enabled and fitted)
+        self.export_data_button.setEnabled(enabled and fitted)
+
+    def on_task_failed(self, title, error):
+        self.set_fitting_enabled(True)
+        QMessageBox.warning(self, title, f'{type(error).__name__}: {error}')
+
+    def on_fitted(self, _, current_index):
+        self.set_fitting_enabled(True)
+        for index, parameter in enumerate(self.analysis.fitted_output_parameters):
             self.fitting_boxes[current_index][index].setValue(parameter)
 
-        self.fit_x = linspace(start=float(self.thermmap.temperatures[0]), stop=float(self.thermmap.temperatures[-1]), num=1000)
-        self.fitted_output_data = [fitting_function(x_value, *self.fitted_output_parameters) for x_value in self.fit_x]
-
         if self.fitting_plot is not None:
             self.fitting_plot[0].remove()
         self.fitting_plot = self.fitting_canvas.parameter_axes.plot(
-            self.fit_x,
-            self.fitted_output_data,
+            self.analysis.fit_x,
+            self.analysis.fitted_output_data,
             color='#6D597A'
         )
         
-        self.sensitivity = (abs(gradient(self.fitted_output_data, self.fit_x))/self.fitted_output_data)*100
-        self.discontinuous_sensitivity = []
-        scale_index = 0
-        while len(self.discontinuous_sensitivity) != len(self.thermmap.temperatures):
-            self.discontinuous_sensitivity = []
-            for temperature in self.thermmap.temperatures:
-                for index, value in enumerate(self.fit_x):
-                    if isclose(temperature, value, rtol=10**(-5+scale_index)):
-                        self.discontinuous_sensitivity.append(self.sensitivity[index])
-                        break
-            scale_index += 1
-        self.discontinuous_sensitivity = array(self.discontinuous_sensitivity)
         if self.sensitivity_plot is not None:
             self.sensitivity_plot[0].remove()
         else:
             self.fitting_canvas.sensitivity_axes.axhline(1, color='#444444', linestyle='--')
         self.sensitivity_plot = self.fitting_canvas.sensitivity_axes.plot(
-            self.fit_x,
-            self.sensitivity,
+            self.analysis.fit_x,
+            self.analysis.sensitivity,
             color='#E56B6F'
         )
+        if self.sensitivity_band is not None:
+            self.sensitivity_band.remove()
+        self.sensitivity_band = self.fitting_canvas.sensitivity_axes.fill_between(
+            self.analysis.fit_x,
+            self.analysis.sensitivity - self.analysis.sensitivity_err,
+            self.analysis.sensitivity + self.analysis.sensitivity_err,
+            color='#E56B6F',
+            alpha=0.2,
+            linewidth=0
+        )
         self.fitting_canvas.sensitivity_axes.set_ylabel(r'Relative sensitivity / %$\cdot\mathrm{K}^{-1}$', color='#E56B6F')
         self.fitting_canvas.sensitivity_axes.tick_params(axis='y', labelcolor='#E56B6F')
         self.fitting_canvas.sensitivity_axes.autoscale()
@@ -731,58 +752,51 @@ class MainWindow(QMainWindow):
     def determine_error(self):
         dialog = ErrorDeterminingDialog(self.thermmap, self)
         if dialog.exec() == QDialog.DialogCode.Accepted:
-            self.smoothed_data, self.smoothed_residual = dialog.smoothed_data, dialog.smoothed_residual
-
-            detector_err = self.thermometric_parameter * sqrt((self.thermmap.general_get_row_of_ydata(self.smoothed_residual, self.first_line_position) / self.thermmap.get_row_of_ydata(self.first_line_position))**2 + 
-                                                              (self.thermmap.general_get_row_of_ydata(self.smoothed_residual, self.second_line_position) / self.thermmap.get_row_of_ydata(self.second_line_position))**2)
-
-            # function_err = list(dict_of_fitting_errors_functions.values())[self.fitting_functions_layout.currentIndex()](self.thermometric_parameter, *self.fitted_output_parameters, *self.parameter_errors)
-            function_err = abs(self.thermometric_parameter - list(dict_of_fitting_functions.values())[self.fitting_functions_layout.currentIndex()](self.thermometric_parameter, *self.fitted_output_parameters))
-
-            total_err = sqrt(detector_err**2 + function_err**2)
-
-            self.temperature_err = (total_err / self.thermometric_parameter) * (1 / self.discontinuous_sensitivity)
-
-            if self.error_bar_plot is not None:
-                self.error_bar_plot[0].remove()
-            self.error_bar_plot = self.fitting_canvas.error_axes.bar(
-                self.thermmap.temperatures,
-                self.temperature_err,
-                color='#E56B6F',
-                width=8
+            self.set_fitting_enabled(False)
+            self.tasks.submit(
+                'error',
+                self.analysis.determine_error,
+                window_length=dialog.window_length_widget.value(),
+                polyorder=dialog.polyorder_widget.value(),
+                delta=dialog.step_widget.value(),
+                workers=settings.get('smoothing_workers', 1),
+                on_finished=self.on_error_determined,
+                on_failed=partial(self.on_task_failed, 'Error determination failed')
             )
-            self.fitting_canvas.error_axes.set_ylim(0, 2)
-            self.fitting_canvas.error_axes.set_ylabel(r'Error / $\mathrm{K}$')
-            self.fitting_canvas.draw()
-        else:
-            return
+
+    def on_error_determined(self, temperature_err):
+        self.set_fitting_enabled(True)
+        if self.error_bar_plot is not None:
+            self.error_bar_plot[0].remove()
+        self.error_bar_plot = self.fitting_canvas.error_axes.bar(
+            self.thermmap.temperatures,
+            temperature_err,
+            color='#E56B6F',
+            width=8
+        )
+        self.fitting_canvas.error_axes.set_ylim(0, 2)
+        self.fitting_canvas.error_axes.set_ylabel(r'Error / $\mathrm{K}$')
+        self.fitting_canvas.draw()
 
     def export_data(self):
-        result_dict = {
-            'Wavlengths / nm': self.thermmap.data[:, 0],
-        }
-        for index, temperature in enumerate(self.thermmap.temperatures):
-            result_dict[f'Intensity {temperature} K / cps'] = self.thermmap.data[:, index + 1]
-        result_dict['Temperature / K'] = self.thermmap.temperatures
-        result_dict[f'Parameter {self.first_line_position} nm / {self.second_line_position} nm'] = self.thermometric_parameter
-        result_dict['Fit temperature / K'] = self.fit_x
-        result_dict['Fitted parameter'] = self.fitted_output_data
-        result_dict['Relative sensitivity / %K^(-1)'] = self.sensitivity
-        if self.temperature_err is not None:
-            result_dict['Error temperature / K'] = self.thermmap.temperatures
-            result_dict['Temperature error / K'] = self.temperature_err
-        for index, fitted_parameter in enumerate(signature(list(dict_of_fitting_functions.values())[self.fitting_functions_layout.currentIndex()]).parameters):
-            if index == 0:
-                continue
-            result_dict[f'Fitted parameter {fitted_parameter}'] = self.fitted_output_parameters[index - 1]
-            result_dict[f'Parameter error {fitted_parameter}'] = self.parameter_errors[index - 1]
-        # self.result = DataFrame.from_dict(result_dict)
-        self.result = DataFrame(dict([(key, Series(value)) for key, value in result_dict.items()]))
         if settings['fast_export']:
-            self.result.to_csv(path.join(settings['recently_opened_folder'], f'Thermometric parameter {self.first_line_position}l{self.second_line_position}.csv'), index=False)
+            filename = self.analysis.default_export_path(settings['recently_opened_folder'])
         else:
-            filename = QFileDialog.getSaveFileName(caption='Save result to a file', directory=settings['recently_opened_folder'], filter='CSV Files (*.csv);;Text Files (*.txt);;Data Files (*.dat);;All files (*.*)', initialFilter='CSV Files (*.csv)')
-            self.result.to_csv(filename)
+            filename, _ = QFileDialog.getSaveFileName(caption='Save result to a file', directory=settings['recently_opened_folder'], filter='CSV Files (*.csv);;Text Files (*.txt);;Data Files (*.dat);;HDF5 Files (*.hdf5);;NumPy Files (*.npz);;Parquet Files (*.parquet);;All files (*.*)', initialFilter='CSV Files (*.csv)')
+            if not filename:
+                return
+        self.export_data_button.setEnabled(False)
+        self.tasks.submit(
+            'export',
+            self.analysis.export,
+            filename,
+            on_finished=lambda _: self.export_data_button.setEnabled(True),
+            on_failed=self.on_export_failed
+        )
+
+    def on_export_failed(self, error):
+        self.export_data_button.setEnabled(True)
+        QMessageBox.warning(self, 'Export failed', f'{type(error).__name__}: {error}')
 
         
     def closeEvent(self, event):
@@ -792,14 +806,25 @@ class MainWindow(QMainWindow):
         
 
 
-def run_gui():
+def run_gui(file_path=None, startup_time=None, on_start=None):
+    """With startup_time (a perf_counter value taken at launch) the time until the main window is shown is printed
+    and the application quits right after. on_start(app) runs before the main window is created."""
     # QApp
     app = QApplication(argv)
     app.setApplicationName('ThermLUM')
     app.setWindowIcon(QIcon(r'.\icon\app_icon.tiff'))
+    started = on_start(app) if on_start is not None else None  # keeps whatever on_start created alive
     # QWidget (MainWindow)
-    window = MainWindow()
+    try:
+        window = MainWindow(file_path=file_path)
+    except TaskCancelled:
+        return
     window.show()
+    if startup_time is not None:
+        QTimer.singleShot(0, lambda: report_startup_time(app, startup_time))
     app.exec()
 
 
+def report_startup_time(app, startup_time):
+    print(f'Main window shown {perf_counter() - startup_time:.3f} s after launch')
+    app.quit()
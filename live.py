@@ -0,0 +1,282 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import re
+import sys
+from glob import glob
+from io import BytesIO
+from os import path, stat
+from time import perf_counter, sleep
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from creation import chunk_shape, chunk_columns, read_export_header
+from fitting import fit_model
+from fitting_functions import dict_of_fitting_functions
+from profiling import profiled
+from sensitivity import relative_sensitivity
+from utilities import WavelengthIndex
+
+temperature_in_name = r'(-?\d+(?:\.\d+)?)\s*K'
+
+
+def gather(buffer, starts, ends):
+    """Concatenated buffer[start:end] ranges, indexed in one go instead of joining a slice per range."""
+    lengths = ends - starts
+    shifts = starts - np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return buffer[np.repeat(shifts, lengths) + np.arange(lengths.sum())].tobytes()
+
+
+class ExportWatcher:
+    """Follows an export the spectrometer rewrites with one more temperature column after every scan. The cells read
+    before keep their text, so the byte length of the part of every row already read is remembered and each poll
+    parses only what follows it. Finding the rows is a single vectorized search for line ends."""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.signature = None
+        self.number_of_temperatures = 0
+        self.x_data = None
+        self.read_lengths = None
+
+    def poll(self):
+        """New (temperatures, wavelengths, wavelengths x temperatures intensities) or None."""
+        if not path.exists(self.file_path):
+            return None
+        status = stat(self.file_path)
+        signature = (status.st_size, status.st_mtime_ns)
+        if signature == self.signature:
+            return None
+        with open(self.file_path, 'r') as file:
+            temperatures = read_export_header(file)
+            body_start = file.tell()
+        if len(temperatures) <= self.number_of_temperatures:
+            self.signature = signature
+            return None
+        with open(self.file_path, 'rb') as file:
+            file.seek(body_start)
+            body = np.frombuffer(file.read(), dtype=np.uint8)
+        # a scan written only partially ends in the middle of a row or has fewer values in its last rows
+        if not len(body) or body[-1] != ord('\n'):
+            return None
+        line_ends = np.flatnonzero(body == ord('\n'))
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+        content_ends = line_ends - (body[line_ends - 1] == ord('\r'))
+        rows = content_ends > line_starts
+        line_starts, line_ends, content_ends = line_starts[rows], line_ends[rows], content_ends[rows]
+        number_of_new = len(temperatures) - self.number_of_temperatures
+        if self.read_lengths is None:
+            block = pd.read_csv(BytesIO(body.tobytes()), sep=',', header=None, usecols=range(len(temperatures) + 1),
+                                dtype=np.float64).to_numpy()
+            x_data, block = block[:, 0], block[:, 1:]
+        elif len(line_starts) == len(self.read_lengths):
+            text = gather(body, line_starts + self.read_lengths, line_ends + 1)
+            block = pd.read_csv(BytesIO(text), sep=',', header=None, usecols=range(number_of_new),
+                                dtype=np.float64).to_numpy()
+            x_data = self.x_data
+        else:
+            return None
+        if block.shape != (len(x_data), number_of_new) or np.isnan(block).any():
+            return None
+        self.signature = signature
+        self.x_data = x_data
+        # a row without a trailing comma gets one in front of the next cell
+        self.read_lengths = content_ends - line_starts + (body[content_ends - 1] != ord(','))
+        new_temperatures = temperatures[self.number_of_temperatures:]
+        self.number_of_temperatures = len(temperatures)
+        return new_temperatures, x_data, block
+
+
+class ScanDirectoryWatcher:
+    """Follows a directory receiving one spectrum file (wavelength, intensity rows) per temperature. The temperature
+    is read from the file name, e.g. 'scan_120.5K.txt'. A file is read once its size stayed the same for one poll,
+    so scans still being written are skipped."""
+    def __init__(self, directory, pattern='*.txt', temperature_pattern=temperature_in_name):
+        self.directory = directory
+        self.pattern = pattern
+        self.temperature_pattern = re.compile(temperature_pattern)
+        self.seen = set()
+        self.sizes = {}
+
+    def read_scan(self, file_path):
+        scan = pd.read_csv(file_path, sep=',', header=None, usecols=[0, 1], comment='#').to_numpy(dtype=np.float64)
+        return scan[np.isfinite(scan).all(axis=1)]
+
+    def is_complete(self, file_path):
+        size = stat(file_path).st_size
+        previous_size, self.sizes[file_path] = self.sizes.get(file_path), size
+        return size > 0 and size == previous_size
+
+    def poll(self):
+        scans = []
+        for file_path in glob(path.join(self.directory, self.pattern)):
+            if file_path in self.seen:
+                continue
+            match = self.temperature_pattern.search(path.basename(file_path))
+            if match is None:
+                self.seen.add(file_path)
+                continue
+            if not self.is_complete(file_path):
+                continue
+            scans.append((stat(file_path).st_mtime_ns, float(match.group(1)), file_path))
+        if not scans:
+            return None
+        temperatures, x_data, columns = [], None, []
+        for _, temperature, file_path in sorted(scans):
+            self.seen.add(file_path)
+            scan = self.read_scan(file_path)
+            if x_data is None:
+                x_data = scan[:, 0]
+            if len(scan) != len(x_data):
+                scan = np.column_stack((x_data, np.interp(x_data, scan[:, 0], scan[:, 1])))
+            temperatures.append(temperature)
+            columns.append(scan[:, 1])
+        if not temperatures:
+            return None
+        return np.array(temperatures), x_data, np.column_stack(columns)
+
+
+def create_growing_map(hdf_file_path, hdf_name, x_data):
+    """Empty map on the given wavelengths, chunked so that appending temperatures touches only the last chunks."""
+    with h5py.File(hdf_file_path, 'w') as hdf_file:
+        group = hdf_file.create_group(hdf_name)
+        data = group.create_dataset(f'data_{hdf_name}', shape=(len(x_data), 1), maxshape=(None, None),
+                                    chunks=chunk_shape(chunk_columns), dtype=np.float64)
+        data[:, 0] = x_data
+        group.create_dataset(f'temperatures_{hdf_name}', shape=(0,), maxshape=(None,), dtype=np.float64)
+    from thermmap_object import ThermMap
+    return ThermMap(hdf_file_path, hdf_name)
+
+
+class LiveCalibration:
+    """Thermometric parameter and calibration fit of a map that grows scan by scan. Every update reads only the two
+    selected rows of the new columns and refits starting from the previous parameters."""
+    def __init__(self, thermmap, first_line_position, second_line_position, model, initial_parameters,
+                 fixed_parameters=None):
+        self.thermmap = thermmap
+        self.model = model
+        self.parameters = np.asarray(initial_parameters, dtype=np.float64)
+        self.fixed_parameters = fixed_parameters
+        self.covariance = None
+        self.temperatures = np.empty(0)
+        self.thermometric_parameter = np.empty(0)
+        self.first_line_position = first_line_position
+        self.second_line_position = second_line_position
+        self.rows = None
+        if thermmap.dataset.shape[1] > 1:
+            self.add_columns(thermmap.get_temperatures(), 0)
+
+    def _line_rows(self):
+        if self.rows is None:
+            index = WavelengthIndex(self.thermmap.get_x_data())
+            self.rows = [int(index.nearest(position)) for position in (self.first_line_position, self.second_line_position)]
+        return self.rows
+
+    def add_columns(self, temperatures, first_column):
+        first_row, second_row = self._line_rows()
+        columns = slice(first_column + 1, first_column + 1 + len(temperatures))
+        # h5py selections have to be increasing and unique, the two lines may share a row
+        unique_rows, inverse = np.unique([first_row, second_row], return_inverse=True)
+        rows = self.thermmap.dataset[unique_rows.tolist(), columns][inverse]
+        self.temperatures = np.concatenate([self.temperatures, temperatures])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.thermometric_parameter = np.concatenate([self.thermometric_parameter, rows[0] / rows[1]])
+
+    @profiled('LiveCalibration.update')
+    def update(self, temperatures, x_data, columns):
+        """Appends new scans to the map and refits. Returns the fitted parameters."""
+        map_x_data = self.thermmap.get_x_data()
+        if len(x_data) != len(map_x_data) or not np.allclose(x_data, map_x_data):
+            columns = np.column_stack([np.interp(map_x_data, x_data, column) for column in columns.T])
+        first_column = self.thermmap.append_temperatures(temperatures, columns)
+        self.add_columns(temperatures, first_column)
+        return self.refit()
+
+    def refit(self):
+        fixed_parameters = self.fixed_parameters
+        number_of_free = len(self.parameters) if fixed_parameters is None else sum(value is None for value in fixed_parameters)
+        valid = np.isfinite(self.thermometric_parameter)
+        if valid.sum() <= number_of_free:
+            return None
+        try:
+            self.parameters, self.covariance, _ = fit_model(self.model, self.temperatures[valid],
+                                                            self.thermometric_parameter[valid], self.parameters,
+                                                            fixed_parameters)
+        except (RuntimeError, ValueError):
+            return None
+        return self.parameters
+
+    def curve(self, points=200):
+        fit_x = np.linspace(self.temperatures.min(), self.temperatures.max(), points)
+        return (fit_x, dict_of_fitting_functions[self.model](fit_x, *self.parameters),
+                relative_sensitivity(self.model, fit_x, self.parameters))
+
+
+def watch(source, first_line_position, second_line_position, model, initial_parameters, interval=1.0, pattern='*.txt',
+          output=None, callback=None, stop=None):
+    """Polls source, an export file or a directory of per-temperature scans, every interval seconds and keeps the
+    calibration of the growing map up to date. callback(calibration, latency) runs after every update; stop() ends
+    the loop when it returns True."""
+    if path.isdir(source):
+        watcher = ScanDirectoryWatcher(source, pattern)
+        name = path.basename(path.normpath(source))
+        hdf_file_path = output or path.join(source, name + '.hdf5')
+    else:
+        watcher = ExportWatcher(source)
+        name = path.splitext(path.basename(source))[0]
+        hdf_file_path = output or path.splitext(source)[0] + '.hdf5'
+    calibration = None
+    while stop is None or not stop():
+        start = perf_counter()
+        scans = watcher.poll()
+        if scans is not None:
+            temperatures, x_data, columns = scans
+            if calibration is None:
+                calibration = LiveCalibration(create_growing_map(hdf_file_path, name, x_data), first_line_position,
+                                              second_line_position, model, initial_parameters)
+            calibration.update(temperatures, x_data, columns)
+            if callback is not None:
+                callback(calibration, perf_counter() - start)
+        else:
+            sleep(interval)
+    return calibration
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Follow a temperature sweep while it is measured and keep the calibration fit up to date.')
+    parser.add_argument('source', help='growing spectrometer export or directory receiving one scan file per temperature')
+    parser.add_argument('--first', type=float, required=True, help='numerator wavelength / nm')
+    parser.add_argument('--second', type=float, required=True, help='denominator wavelength / nm')
+    parser.add_argument('--model', default='Single Mott-Seitz', choices=list(dict_of_fitting_functions))
+    parser.add_argument('--initial', nargs='+', type=float, required=True, help='starting value of every model parameter')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between polls')
+    parser.add_argument('--pattern', default='*.txt', help='scan file pattern in a directory source')
+    parser.add_argument('--output', default=None, help='HDF5 file of the growing map')
+    arguments = parser.parse_args(arguments)
+
+    def report(calibration, latency):
+        parameters = ', '.join(f'{value:.4g}' for value in calibration.parameters)
+        print(f'{len(calibration.temperatures):4d} scans, last {calibration.temperatures[-1]:g} K, '
+              f'ratio {calibration.thermometric_parameter[-1]:.5g}, fit [{parameters}], {latency * 1e3:.1f} ms')
+
+    try:
+        watch(arguments.source, arguments.first, arguments.second, arguments.model, arguments.initial,
+              arguments.interval, arguments.pattern, arguments.output, report)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
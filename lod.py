@@ -0,0 +1,93 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import numpy as np
+
+from utilities import WavelengthIndex
+
+level_factor = 4  # bin size grows by this factor from one level to the next
+min_level_rows = 1024  # no coarser level is built once a level has fewer rows than this
+
+
+def decimate(data, bin_size):
+    """Min/max decimation of a (wavelengths x 1+temperatures) map. Every bin of bin_size rows becomes two rows at the
+    bin centre holding the minimum and the maximum of each spectrum, so peaks survive any level of decimation."""
+    number_of_bins = -(-data.shape[0] // bin_size)
+    padding = number_of_bins * bin_size - data.shape[0]
+    if padding:
+        # the last bin is filled up with copies of its final row, which do not change its minimum or maximum
+        data = np.concatenate([data, np.repeat(data[-1:], padding, axis=0)])
+    bins = data.reshape(number_of_bins, bin_size, data.shape[1])
+    decimated = np.empty((2 * number_of_bins, data.shape[1]), dtype=np.float64)
+    decimated[0::2, 1:] = bins[:, :, 1:].min(axis=1)
+    decimated[1::2, 1:] = bins[:, :, 1:].max(axis=1)
+    decimated[0::2, 0] = decimated[1::2, 0] = 0.5 * (bins[:, 0, 0] + bins[:, -1, 0])
+    return decimated
+
+
+def build_levels(data, factor=level_factor, min_rows=min_level_rows):
+    """Levels of bin size factor, factor**2, ... of the full map, each decimated from the previous level."""
+    levels = {}
+    bin_size = factor
+    level = decimate(data, factor)
+    while True:
+        levels[bin_size] = level
+        if level.shape[0] < min_rows:
+            return levels
+        # min and max rows of the previous level are kept in pairs, so a bin of factor pairs spans 2 * factor rows
+        bin_size *= factor
+        level = decimate(level, 2 * factor)
+
+
+class SpectralPyramid:
+    """Works for ascending and descending wavelength axes, the levels keep the direction of the map."""
+    def __init__(self, data, levels):
+        self.data = data
+        self.levels = levels
+        self.x_data = np.asarray(data[:, 0], dtype=np.float64)
+        self.wavelength_index = WavelengthIndex(self.x_data)
+        self.level_indices = {1: self.wavelength_index}
+
+    @classmethod
+    def from_array(cls, data, factor=level_factor, min_rows=min_level_rows):
+        return cls(data, build_levels(data, factor, min_rows))
+
+    @property
+    def bin_sizes(self):
+        return sorted(self.levels)
+
+    @property
+    def x_range(self):
+        return self.wavelength_index.sorted_x_data[0], self.wavelength_index.sorted_x_data[-1]
+
+    def level_index(self, bin_size):
+        if bin_size not in self.level_indices:
+            self.level_indices[bin_size] = WavelengthIndex(self.levels[bin_size][:, 0])
+        return self.level_indices[bin_size]
+
+    def bin_size_for(self, x_min, x_max, pixels):
+        """Coarsest bin size that still leaves at least one bin per pixel in the x-range, 1 for full resolution."""
+        first, last = np.searchsorted(self.wavelength_index.sorted_x_data, [x_min, x_max])
+        points_per_pixel = (last - first) / max(pixels, 1)
+        return max([bin_size for bin_size in self.bin_sizes if bin_size <= points_per_pixel], default=1)
+
+    def view(self, x_min, x_max, pixels, margin=0.5):
+        """Rows of the appropriate level covering the x-range widened by margin times its width on both sides, so
+        panning does not need a new view until the range leaves the returned one. Returns rows and bin size."""
+        bin_size = self.bin_size_for(x_min, x_max, pixels)
+        data = self.data if bin_size == 1 else self.levels[bin_size]
+        index = self.level_index(bin_size)
+        width = x_max - x_min
+        first, last = np.searchsorted(index.sorted_x_data, [x_min - margin * width, x_max + margin * width])
+        # the rows of a monotonic axis inside the range are contiguous in either direction
+        rows = index.order[max(first - 2, 0):last + 2]
+        return data[rows.min():rows.max() + 1], bin_size
@@ -0,0 +1,152 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+import numpy as np
+
+max_block_bytes = 64 * 1024 ** 2  # bounds the (rows x wavelengths x temperatures) block evaluated at once
+
+_log_derivatives = None
+
+
+def band_edges(x_data, band_width):
+    return np.arange(x_data.min(), x_data.max() + 0.5 * band_width, band_width)
+
+
+def log_derivatives(y_data, temperatures, min_intensity=0.0):
+    """d ln(I)/dT for every wavelength. Relative sensitivity of the ratio of rows i and j is |G_i - G_j| * 100."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logarithm = np.where(y_data > min_intensity, np.log(y_data), np.nan)
+    return np.gradient(logarithm, temperatures, axis=1)
+
+
+def _initialize_worker(derivatives):
+    global _log_derivatives
+    _log_derivatives = derivatives
+
+
+def _score_block(start, stop, derivatives=None):
+    if derivatives is None:
+        derivatives = _log_derivatives
+    # only pairs with j >= start are evaluated, the rest of the matrix follows from symmetry
+    difference = derivatives[start:stop, np.newaxis, :] - derivatives[np.newaxis, start:, :]
+    with np.errstate(invalid='ignore'):
+        sensitivity = np.abs(difference) * 100
+        valid = np.sum(np.isfinite(difference), axis=2)
+        maximum = np.fmax.reduce(sensitivity, axis=2)
+        mean = np.nansum(sensitivity, axis=2) / valid
+        monotonicity = np.abs(np.nansum(np.sign(difference), axis=2)) / valid
+    return start, stop, maximum, mean, monotonicity
+
+
+class PairSearchResult:
+    def __init__(self, x_data, max_sensitivity, mean_sensitivity, monotonicity):
+        self.x_data = x_data
+        self.max_sensitivity = max_sensitivity
+        self.mean_sensitivity = mean_sensitivity
+        self.monotonicity = monotonicity
+
+    def ranking(self, top=10, by='max', min_monotonicity=0.0):
+        """Best (numerator, denominator, max Sr, mean Sr, monotonicity) pairs. Each unordered pair is listed once."""
+        score = self.max_sensitivity if by == 'max' else self.mean_sensitivity
+        first, second = np.triu_indices(len(self.x_data), k=1)
+        score = score[first, second]
+        keep = np.isfinite(score) & (self.monotonicity[first, second] >= min_monotonicity)
+        first, second, score = first[keep], second[keep], score[keep]
+        best = np.argsort(score)[::-1][:top]
+        return [(self.x_data[i], self.x_data[j], self.max_sensitivity[i, j], self.mean_sensitivity[i, j],
+                 self.monotonicity[i, j]) for i, j in zip(first[best], second[best])]
+
+
+def search_pairs(x_data, y_data, temperatures, min_intensity=0.0, workers=1):
+    """Scores every wavelength pair of a (wavelengths x temperatures) intensity matrix by the relative sensitivity
+    of their ratio, obtained by differentiating the ratio at the measured temperatures."""
+    derivatives = log_derivatives(np.asarray(y_data, dtype=np.float64), temperatures, min_intensity)
+    n = len(x_data)
+    rows_per_block = max(1, max_block_bytes // (8 * n * len(temperatures)))
+    blocks = [(start, min(start + rows_per_block, n)) for start in range(0, n, rows_per_block)]
+    max_sensitivity = np.full((n, n), np.nan)
+    mean_sensitivity = np.full((n, n), np.nan)
+    monotonicity = np.full((n, n), np.nan)
+
+    def store(block):
+        start, stop, maximum, mean, monotonic = block
+        for matrix, values in ((max_sensitivity, maximum), (mean_sensitivity, mean), (monotonicity, monotonic)):
+            matrix[start:stop, start:] = values
+            matrix[start:, start:stop] = values.T
+
+    if workers is None:
+        workers = cpu_count() or 1
+    if workers == 1 or len(blocks) == 1:
+        for start, stop in blocks:
+            store(_score_block(start, stop, derivatives))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker, initargs=(derivatives,)) as executor:
+            for block in executor.map(_score_block, *zip(*blocks)):
+                store(block)
+    np.fill_diagonal(max_sensitivity, np.nan)
+    np.fill_diagonal(mean_sensitivity, np.nan)
+    np.fill_diagonal(monotonicity, np.nan)
+    return PairSearchResult(np.asarray(x_data, dtype=np.float64), max_sensitivity, mean_sensitivity, monotonicity)
+
+
+def search_thermmap(thermmap, band_width=None, x_range=None, min_intensity=0.0, workers=1):
+    if thermmap.data is None:
+        thermmap.get_data()
+    if thermmap.temperatures is None:
+        thermmap.get_temperatures()
+    x_data, y_data = thermmap.x_data, thermmap.data[:, 1:]
+    if x_range is not None:
+        inside = (x_data >= x_range[0]) & (x_data <= x_range[1])
+        x_data, y_data = x_data[inside], y_data[inside]
+    if band_width:
+        # the windows are cut from the cumulative integral stored with the map instead of integrating it again
+        edges = band_edges(x_data, band_width)
+        y_data = thermmap.band_integrals(np.column_stack((edges[:-1], edges[1:])))
+        x_data = 0.5 * (edges[:-1] + edges[1:])
+    return search_pairs(x_data, y_data, thermmap.temperatures, min_intensity, workers)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Rank every wavelength (or band) pair of a map as a ratiometric thermometer.')
+    parser.add_argument('source', help='spectrometer export or converted .hdf5 map')
+    parser.add_argument('--band-width', type=float, default=None, help='integrate bands of this width / nm')
+    parser.add_argument('--range', nargs=2, type=float, default=None, metavar=('MIN', 'MAX'), help='wavelength range / nm')
+    parser.add_argument('--min-intensity', type=float, default=0.0, help='ignore points at or below this intensity')
+    parser.add_argument('--min-monotonicity', type=float, default=1.0, help='fraction of temperatures with the same trend')
+    parser.add_argument('--by', choices=['max', 'mean'], default='max')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--heatmap', default=None, help='save the sensitivity heatmap to this image file')
+    arguments = parser.parse_args(arguments)
+
+    from pipeline import open_thermmap
+    result = search_thermmap(open_thermmap(arguments.source), arguments.band_width, arguments.range,
+                             arguments.min_intensity, arguments.workers)
+    print('numerator / nm  denominator / nm  max Sr / %K^-1  mean Sr / %K^-1  monotonicity')
+    for first, second, maximum, mean, monotonicity in result.ranking(arguments.top, arguments.by, arguments.min_monotonicity):
+        print(f'{first:14.3f}  {second:16.3f}  {maximum:14.3f}  {mean:15.3f}  {monotonicity:12.2f}')
+    if arguments.heatmap is not None:
+        from matplotlib.figure import Figure
+        from plotting import sensitivity_heatmap
+        figure = Figure(figsize=(6, 5))
+        sensitivity_heatmap(result, figure.add_subplot(111), by=arguments.by)
+        figure.savefig(arguments.heatmap, dpi=150)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
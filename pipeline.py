@@ -0,0 +1,333 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import sys
+from inspect import signature
+from os import path
+
+from numpy import linspace, sqrt, diag, gradient, newaxis
+
+from export import export
+from fitting import fit_model, multi_start_fit, MultiStartResult
+from fitting_functions import dict_of_fitting_functions, dict_of_temperature_derivatives
+import profiling
+from profiling import profiled
+from sensitivity import relative_sensitivity, relative_sensitivity_error
+from uncertainty import local_residuals, monte_carlo, noise_half_width
+
+
+def parameter_names(model):
+    return list(signature(dict_of_fitting_functions[model]).parameters)[1:]
+
+
+def open_thermmap(file_path):
+    from creation import open_thermmap
+    return open_thermmap(file_path)
+
+
+class Analysis:
+    """Ratio -> fit -> sensitivity -> error -> export of a single map, without any GUI. With band_widths, a
+    (numerator, denominator) pair of widths / nm, the intensities are integrated over windows centred at the line
+    positions instead of being taken at the line positions. A width of 0 keeps the single wavelength for that
+    line."""
+    def __init__(self, thermmap, first_line_position, second_line_position, band_widths=None):
+        self.thermmap = thermmap
+        self.first_line_position = first_line_position
+        self.second_line_position = second_line_position
+        self.band_widths = None if band_widths is None or not any(band_widths) else tuple(band_widths)
+        if self.thermmap.temperatures is None:
+            self.thermmap.get_temperatures()
+        self.thermometric_parameter = None
+        self.model = None
+        self.fitted_output_parameters = None
+        self.covariance = None
+        self.multi_start = None
+        self.parameter_errors = None
+        self.fit_x = None
+        self.fitted_output_data = None
+        self.sensitivity = None
+        self.sensitivity_err = None
+        self.discontinuous_sensitivity = None
+        self.discontinuous_sensitivity_err = None
+        self.smoothed_data = None
+        self.smoothed_residual = None
+        self.temperature_err = None
+        self.fixed_parameters = None
+        self.monte_carlo_result = None
+
+    def bands(self):
+        """(start, end) wavelength windows of the numerator and the denominator, None for single-wavelength ratios."""
+        if self.band_widths is None:
+            return None
+        return tuple((position - width / 2, position + width / 2) for position, width
+                     in zip((self.first_line_position, self.second_line_position), self.band_widths))
+
+    @profiled()
+    def create_thermometric_parameter(self, save=True):
+        if self.band_widths is not None:
+            self.thermometric_parameter = self.thermmap.band_ratio(*self.bands(), save=save)
+        else:
+            self.thermometric_parameter = self.thermmap.ratio(self.first_line_position, self.second_line_position,
+                                                              save=save)
+        return self.thermometric_parameter
+
+    @profiled()
+    def fit(self, model, initial_parameters=None, blocked_parameters=None, number_of_starts=1, workers=None, seed=None):
+        """initial_parameters holds a starting value or None for every model parameter, blocked_parameters a bool for
+        every model parameter. A blocked parameter with a starting value is fixed at that value and left out of the
+        optimization. With number_of_starts > 1 the fit is repeated from Latin hypercube starting points."""
+        if self.thermometric_parameter is None:
+            self.create_thermometric_parameter()
+        self.model = model
+        fitting_function = dict_of_fitting_functions[model]
+        number_of_parameters = len(parameter_names(model))
+        if initial_parameters is None:
+            initial_parameters = [None] * number_of_parameters
+        if blocked_parameters is None:
+            blocked_parameters = [False] * number_of_parameters
+        current_initial_parameters = [1.0 if value is None else value for value in initial_parameters]
+        fixed_parameters = [value if block else None for value, block in zip(initial_parameters, blocked_parameters)]
+        self.fixed_parameters = fixed_parameters
+
+        fit_parameters = {
+            'model': model,
+            'first': self.first_line_position,
+            'second': self.second_line_position,
+            'p0': current_initial_parameters,
+            'fixed': fixed_parameters,
+            'starts': number_of_starts,
+            'seed': seed
+        }
+        if self.band_widths is not None:
+            fit_parameters['band_widths'] = self.band_widths
+        cached_fit = self.thermmap.cache.get('fit', fit_parameters)
+        if cached_fit is not None:
+            self.fitted_output_parameters, self.covariance = cached_fit['fitted_parameters'], cached_fit['covariance']
+            self.multi_start = None
+            if 'solutions' in cached_fit:
+                self.multi_start = MultiStartResult(self.fitted_output_parameters, self.covariance,
+                                                    cached_fit['costs'].min(), cached_fit['solutions'], cached_fit['costs'])
+        elif number_of_starts > 1:
+            self.multi_start = multi_start_fit(model, self.thermmap.temperatures, self.thermometric_parameter,
+                                               current_initial_parameters, fixed_parameters, number_of_starts, workers, seed)
+            self.fitted_output_parameters, self.covariance = self.multi_start.parameters, self.multi_start.covariance
+            self.thermmap.cache.put('fit', fit_parameters, fitted_parameters=self.fitted_output_parameters,
+                                    covariance=self.covariance, solutions=self.multi_start.solutions,
+                                    costs=self.multi_start.costs)
+        else:
+            self.multi_start = None
+            self.fitted_output_parameters, self.covariance, _ = fit_model(
+                model, self.thermmap.temperatures, self.thermometric_parameter, current_initial_parameters,
+                fixed_parameters)
+            self.thermmap.cache.put('fit', fit_parameters, fitted_parameters=self.fitted_output_parameters,
+                                    covariance=self.covariance)
+        self.parameter_errors = sqrt(diag(self.covariance))
+
+        self.fit_x = linspace(start=float(self.thermmap.temperatures[0]), stop=float(self.thermmap.temperatures[-1]), num=1000)
+        self.fitted_output_data = fitting_function(self.fit_x, *self.fitted_output_parameters)
+        self.determine_sensitivity()
+        return self.fitted_output_parameters, self.parameter_errors
+
+    @profiled()
+    def determine_sensitivity(self):
+        self.sensitivity = relative_sensitivity(self.model, self.fit_x, self.fitted_output_parameters)
+        self.sensitivity_err = relative_sensitivity_error(self.model, self.fit_x, self.fitted_output_parameters,
+                                                          self.covariance)
+        self.discontinuous_sensitivity = relative_sensitivity(self.model, self.thermmap.temperatures,
+                                                              self.fitted_output_parameters)
+        self.discontinuous_sensitivity_err = relative_sensitivity_error(self.model, self.thermmap.temperatures,
+                                                                        self.fitted_output_parameters, self.covariance)
+        return self.sensitivity
+
+    def smooth(self, window_length, polyorder, delta=1, workers=1):
+        self.smoothed_data, self.smoothed_residual = self.thermmap.smooth(
+            window_length=window_length,
+            polyorder=polyorder,
+            delta=delta,
+            save=True,
+            workers=workers
+        )
+        return self.smoothed_data, self.smoothed_residual
+
+    @profiled()
+    def determine_error(self, window_length=None, polyorder=None, delta=1, workers=1):
+        if window_length is not None:
+            self.smooth(window_length, polyorder, delta, workers)
+        if self.band_widths is not None:
+            detector_err = self.band_detector_error()
+        else:
+            first_row = self.thermmap.get_row_of_ydata(self.first_line_position)
+            second_row = self.thermmap.get_row_of_ydata(self.second_line_position)
+            detector_err = self.thermometric_parameter * sqrt((self.thermmap.general_get_row_of_ydata(self.smoothed_residual, self.first_line_position) / first_row)**2 +
+                                                              (self.thermmap.general_get_row_of_ydata(self.smoothed_residual, self.second_line_position) / second_row)**2)
+
+        function_err = abs(self.thermometric_parameter - dict_of_fitting_functions[self.model](self.thermmap.temperatures, *self.fitted_output_parameters))
+
+        total_err = sqrt(detector_err**2 + function_err**2)
+
+        # dT = dDelta / |dDelta/dT|, i.e. (dDelta / Delta) / Sr with Sr taken as a fraction rather than in %/K
+        derivative = dict_of_temperature_derivatives[self.model](self.thermmap.temperatures, *self.fitted_output_parameters)
+        self.temperature_err = total_err / abs(derivative)
+        return self.temperature_err
+
+    def band_detector_error(self):
+        """Error of the band ratio from the smoothing residuals of the rows inside both windows, treated as
+        independent: the error of an integral is the root sum of squares of residual * wavelength step. A window of
+        zero width takes the residual at its line, as for single-wavelength ratios."""
+        x_data = self.thermmap.x_data
+        steps = abs(gradient(x_data))
+        relative_errors = []
+        for (start, end), integral in zip(self.bands(), self.thermmap.band_integrals(self.bands())):
+            if start == end:
+                noise = abs(self.thermmap.wavelength_index.interpolate(start, self.smoothed_residual[:, 1:]))
+            else:
+                inside = (x_data >= start) & (x_data <= end)
+                noise = sqrt(((self.smoothed_residual[inside, 1:] * steps[inside, newaxis])**2).sum(axis=0))
+            relative_errors.append(noise / integral)
+        return self.thermometric_parameter * sqrt(relative_errors[0]**2 + relative_errors[1]**2)
+
+    @profiled()
+    def determine_error_monte_carlo(self, number_of_samples=1000, noise='bootstrap', seed=None, workers=None,
+                                    window_length=None, polyorder=None, delta=1, smoothing_workers=1,
+                                    half_width=noise_half_width):
+        """Temperature uncertainty from refitting the calibration to number_of_samples noisy copies of the two lines.
+        The noise is taken from the Savitzky-Golay residuals within half_width rows of each line."""
+        if window_length is not None:
+            self.smooth(window_length, polyorder, delta, smoothing_workers)
+        if self.smoothed_residual is None:
+            raise ValueError('The data has to be smoothed before the Monte Carlo error determination')
+        if self.band_widths is not None:
+            raise ValueError('The Monte Carlo error determination is only available for single-wavelength ratios')
+        positions = [self.first_line_position, self.second_line_position]
+        rows = self.thermmap.wavelength_index.find(positions)
+        if any(rows < 0):
+            raise ValueError(f'Wavelengths {[position for position, row in zip(positions, rows) if row < 0]} are not '
+                             f'on the wavelength axis')
+        self.monte_carlo_result = monte_carlo(
+            self.model,
+            self.thermmap.temperatures,
+            [self.smoothed_data[row, 1:] for row in rows],
+            [local_residuals(self.smoothed_residual, row, half_width) for row in rows],
+            self.fitted_output_parameters,
+            self.fixed_parameters,
+            self.fit_x,
+            number_of_samples=number_of_samples,
+            noise=noise,
+            seed=seed,
+            workers=workers
+        )
+        return self.monte_carlo_result
+
+    def default_export_path(self, directory=None, extension='.csv'):
+        if directory is None:
+            directory = self.thermmap.directory
+        name = f'Thermometric parameter {self.first_line_position}l{self.second_line_position}'
+        if self.band_widths is not None:
+            name += f' band {self.band_widths[0]}l{self.band_widths[1]}'
+        return path.join(directory, name + extension)
+
+    def parameter_names(self):
+        return parameter_names(self.model)
+
+    def export(self, file_path=None, export_format=None):
+        """Writes the results to file_path, by default a CSV file next to the map. The format follows the extension
+        (.csv/.txt/.dat, .hdf5/.h5, .npz, .parquet) unless export_format is given."""
+        if file_path is None:
+            file_path = self.default_export_path()
+        return export(self, file_path, export_format)
+
+
+def analyse(thermmap, first_line_position, second_line_position, model, window_length=None, polyorder=None, delta=1,
+            initial_parameters=None, blocked_parameters=None, workers=1, export_path=None, number_of_starts=1,
+            seed=None, monte_carlo_samples=0, noise='bootstrap', band_widths=None):
+    analysis = Analysis(thermmap, first_line_position, second_line_position, band_widths)
+    analysis.create_thermometric_parameter()
+    analysis.fit(model, initial_parameters, blocked_parameters, number_of_starts, None, seed)
+    if window_length is not None:
+        analysis.determine_error(window_length, polyorder, delta, workers)
+        if monte_carlo_samples:
+            analysis.determine_error_monte_carlo(monte_carlo_samples, noise, seed)
+    if export_path is not False:
+        analysis.export(export_path)
+    return analysis
+
+
+def _optional_float(text):
+    return None if text.lower() == 'none' else float(text)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Run the ThermLUM ratio, fit, sensitivity and error analysis headlessly.')
+    parser.add_argument('sources', nargs='+', help='spectrometer exports or converted .hdf5 maps')
+    parser.add_argument('--first', type=float, required=True, help='numerator wavelength / nm')
+    parser.add_argument('--second', type=float, required=True, help='denominator wavelength / nm')
+    parser.add_argument('--band-width', nargs='+', type=float, default=None, metavar='WIDTH',
+                        help='integrate windows of this width / nm around the lines; a second value sets the denominator window')
+    parser.add_argument('--model', default='Single Mott-Seitz', choices=list(dict_of_fitting_functions))
+    parser.add_argument('--initial', nargs='*', type=_optional_float, default=None,
+                        help='starting value for every model parameter, "none" for the default')
+    parser.add_argument('--block', nargs='*', default=None, help='names of parameters kept at their starting value')
+    parser.add_argument('--starts', type=int, default=1, help='number of multi-start fits run in parallel')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the multi-start starting points')
+    parser.add_argument('--window-length', type=int, default=None, help='Savitzky-Golay window; enables error determination')
+    parser.add_argument('--polyorder', type=int, default=5)
+    parser.add_argument('--delta', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=1, help='threads used for smoothing')
+    parser.add_argument('--monte-carlo', type=int, default=0, metavar='SAMPLES',
+                        help='Monte Carlo error determination with this many samples (needs --window-length)')
+    parser.add_argument('--noise', choices=['bootstrap', 'gaussian'], default='bootstrap',
+                        help='noise model of the Monte Carlo samples')
+    parser.add_argument('--output', default=None, help='directory for exported files (default: next to the map)')
+    parser.add_argument('--format', choices=['csv', 'hdf5', 'npz', 'parquet'], default='csv', help='export format')
+    parser.add_argument('--profile', default=None, metavar='JSON', help='write timings of every step to this file')
+    parser.add_argument('--cprofile', default=None, metavar='PROF', help='write cProfile statistics of the first source')
+    arguments = parser.parse_args(arguments)
+    if arguments.profile is not None:
+        profiling.enable()
+    if arguments.cprofile is not None:
+        profiling.profile_next(arguments.cprofile)
+
+    names = parameter_names(arguments.model)
+    blocked_parameters = None
+    if arguments.block:
+        blocked_parameters = [name in arguments.block for name in names]
+    band_widths = None
+    if arguments.band_width:
+        band_widths = (arguments.band_width[0], arguments.band_width[-1])
+    exit_code = 0
+    for source in arguments.sources:
+        try:
+            with profiling.span('pipeline.analyse'):
+                analysis = analyse(open_thermmap(source), arguments.first, arguments.second, arguments.model,
+                                   window_length=arguments.window_length, polyorder=arguments.polyorder,
+                                   delta=arguments.delta, initial_parameters=arguments.initial,
+                                   blocked_parameters=blocked_parameters, workers=arguments.workers, export_path=False,
+                                   number_of_starts=arguments.starts, seed=arguments.seed,
+                                   monte_carlo_samples=arguments.monte_carlo, noise=arguments.noise,
+                                   band_widths=band_widths)
+            export_path = analysis.export(analysis.default_export_path(arguments.output, f'.{arguments.format}'),
+                                          arguments.format)
+        except Exception as e:
+            print(f'{source}: FAILED {type(e).__name__}: {e}')
+            exit_code = 1
+            continue
+        if arguments.profile is not None:
+            profiling.dump(arguments.profile)
+        fitted = ', '.join(f'{name}={value:.4g}±{error:.2g}' for name, value, error
+                           in zip(names, analysis.fitted_output_parameters, analysis.parameter_errors))
+        print(f'{source}: {fitted}; max Sr {max(analysis.sensitivity):.3f} %/K -> {export_path}')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,16 +10,165 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
-import matplotlib.pyplot as plt
+from time import perf_counter
+
+from matplotlib.axes import Axes
 import numpy as np
+from matplotlib.collections import LineCollection
+
+from profiling import span
 #EGG
 
-def luminescence_dt(data, temperatures, axes: plt.Axes, colormap):
-    counter = 0
-    for temperature in temperatures:
-        axes.plot(data[:, 0], data[:, 1+counter], label=f'{temperature} K', color=colormap(counter), picker=False, linewidth=0.75)
+class SpectraPlot:
+    """All spectra of a map drawn as a single LineCollection. set_data replaces the segments of the existing
+    collection, so updating the plot costs the same for ten or a thousand temperatures."""
+    def __init__(self, axes: Axes, colormap, linewidth=0.75):
+        self.axes = axes
+        self.colormap = colormap
+        self.linewidth = linewidth
+        self.collection = None
+        self.temperatures = None
+        self.render_time = None
+        self.pyramid = None
+        self.bin_size = 1
+        self.loaded_range = None
+        self.xlim_connection = None
+        self.switching_level = False
         axes.set_xlabel('Wavelength / nm')
         axes.set_ylabel('Intensity')
-        counter += 1
 
+    def set_data(self, data, temperatures, autoscale=True):
+        segments = np.empty((data.shape[1] - 1, data.shape[0], 2))
+        segments[:, :, 0] = data[:, 0]
+        segments[:, :, 1] = data[:, 1:].T
+        if self.collection is None:
+            self.collection = LineCollection(segments, linewidths=self.linewidth, picker=False)
+            self.axes.add_collection(self.collection, autolim=False)
+        else:
+            self.collection.set_segments(segments)
+        if self.temperatures is None or len(self.temperatures) != len(temperatures):
+            self.collection.set_colors(self.colormap(np.arange(len(temperatures))))
+        self.temperatures = temperatures
+
+        if autoscale:
+            with np.errstate(invalid='ignore'):
+                low = np.nanmin(segments, axis=(0, 1))
+                high = np.nanmax(segments, axis=(0, 1))
+            self.axes.ignore_existing_data_limits = True
+            self.axes.update_datalim([low, high])
+            self.axes.autoscale_view()
+        return self
+
+    def set_pyramid(self, pyramid, temperatures):
+        """Shows a lod.SpectralPyramid instead of fixed data. Zooming and panning switch to the level matching the
+        visible x-range, down to full resolution when zoomed in."""
+        self.pyramid = pyramid
+        self.temperatures = None
+        self.loaded_range = None
+        if self.xlim_connection is None:
+            self.xlim_connection = self.axes.callbacks.connect('xlim_changed', self.on_xlim_changed)
+        self.show_level(*pyramid.x_range, temperatures, autoscale=True)
+        return self
+
+    def on_xlim_changed(self, axes):
+        if self.pyramid is not None and not self.switching_level:
+            self.show_level(*sorted(axes.get_xlim()), self.temperatures)
+
+    def show_level(self, x_min, x_max, temperatures, autoscale=False):
+        x_min, x_max = max(x_min, self.pyramid.x_range[0]), min(x_max, self.pyramid.x_range[1])
+        pixels = self.axes.bbox.width
+        bin_size = self.pyramid.bin_size_for(x_min, x_max, pixels)
+        if (self.loaded_range is not None and bin_size == self.bin_size and
+                self.loaded_range[0] <= x_min and x_max <= self.loaded_range[1]):
+            return
+        data, self.bin_size = self.pyramid.view(x_min, x_max, pixels)
+        self.loaded_range = (data[:, 0].min(), data[:, 0].max())
+        # autoscaling changes the x-limits, which must not trigger another switch
+        self.switching_level = True
+        try:
+            self.set_data(data, temperatures, autoscale)
+        finally:
+            self.switching_level = False
+
+    def draw(self):
+        """Full redraw of the canvas, timed in render_time / s."""
+        start = perf_counter()
+        with span('SpectraPlot.draw'):
+            self.axes.figure.canvas.draw()
+        self.render_time = perf_counter() - start
+        return self.render_time
+
+
+def sensitivity_heatmap(result, axes: Axes, by='max', colormap='magma'):
+    sensitivity = result.max_sensitivity if by == 'max' else result.mean_sensitivity
+    extent = (result.x_data[0], result.x_data[-1], result.x_data[-1], result.x_data[0])
+    image = axes.imshow(sensitivity, extent=extent, cmap=colormap, aspect='auto', interpolation='nearest')
+    axes.figure.colorbar(image, ax=axes, label=rf'{by.capitalize()} relative sensitivity / %$\cdot\mathrm{{K}}^{{-1}}$')
+    axes.set_xlabel('Denominator / nm')
+    axes.set_ylabel('Numerator / nm')
     return axes
+
+
+class MarkerOverlay:
+    """Vertical marker lines drawn over a cached background. Full draws of the axes store the rendered spectra and
+    moving a marker only restores that background and blits the markers, instead of redrawing every spectrum."""
+    def __init__(self, axes: Axes):
+        self.axes = axes
+        self.canvas = axes.figure.canvas
+        self.background = None
+        self.lines = {}
+        self.styles = {}
+        self.positions = {}
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, _):
+        self.background = self.canvas.copy_from_bbox(self.axes.figure.bbox)
+        self.draw_markers()
+
+    def draw_markers(self):
+        for line in self.lines.values():
+            if line.get_visible():
+                self.axes.draw_artist(line)
+
+    def set_axes(self, axes: Axes):
+        """Recreates the markers on new axes, e.g. after they were cleared and replotted."""
+        self.axes = axes
+        self.lines = {}
+        self.background = None
+        for name, value in self.positions.items():
+            self._create(name, value)
+
+    def _create(self, name, value):
+        self.lines[name] = self.axes.axvline(value, animated=True, **self.styles[name])
+
+    def move(self, name, value, **style):
+        """Shows marker name at value, creating it with the given line style the first time."""
+        self.styles.setdefault(name, style)
+        self.positions[name] = value
+        line = self.lines.get(name)
+        if line is None:
+            self._create(name, value)
+        else:
+            line.set_xdata([value, value])
+            line.set_visible(True)
+        self.blit()
+
+    def hide(self, name):
+        self.positions.pop(name, None)
+        if name in self.lines:
+            self.lines[name].set_visible(False)
+        self.blit()
+
+    def name_of(self, artist):
+        for name, line in self.lines.items():
+            if line is artist:
+                return name
+        return None
+
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_markers()
+        self.canvas.blit(self.axes.figure.bbox)
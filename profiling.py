@@ -0,0 +1,107 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import cProfile
+import json
+from contextlib import contextmanager
+from functools import wraps
+from os import environ
+from threading import Lock, local
+from time import perf_counter
+
+enabled = environ.get('THERMLUM_PROFILE', '') not in ('', '0')
+_timings = {}  # span name -> [calls, total / s, longest / s]
+_lock = Lock()
+_profile_next = None  # file path the next outermost span is written to by cProfile
+_state = local()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+
+
+def profile_next(file_path):
+    """Captures the next outermost span with cProfile and writes the statistics to file_path (readable with pstats
+    or snakeviz). Enables the instrumentation if it was off."""
+    global _profile_next
+    enable()
+    _profile_next = file_path
+
+
+def _record(name, seconds):
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            _timings[name] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block under name. Does nothing while the instrumentation is disabled."""
+    global _profile_next
+    if not enabled:
+        yield
+        return
+    depth = getattr(_state, 'depth', 0)
+    profiler = None
+    if depth == 0 and _profile_next is not None:
+        profiler, profile_path, _profile_next = cProfile.Profile(), _profile_next, None
+        profiler.enable()
+    _state.depth = depth + 1
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, perf_counter() - start)
+        _state.depth = depth
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+
+def profiled(name=None):
+    """Decorator running the function inside span(name), by default its qualified name."""
+    def decorator(function):
+        span_name = function.__qualname__ if name is None else name
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """Aggregated spans sorted by total time."""
+    with _lock:
+        items = [(name, list(timing)) for name, timing in _timings.items()]
+    return [{'name': name, 'calls': calls, 'total': total, 'mean': total / calls, 'max': longest}
+            for name, (calls, total, longest) in sorted(items, key=lambda item: item[1][1], reverse=True)]
+
+
+def dump(file_path):
+    with open(file_path, 'w') as file:
+        json.dump(summary(), file, indent=1)
+    return file_path
@@ -0,0 +1,223 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import argparse
+import json
+import sys
+from os import path
+
+import numpy as np
+from scipy.integrate import cumulative_trapezoid
+
+from fitting_functions import dict_of_fitting_functions, dict_of_fitting_jacobians, dict_of_temperature_derivatives
+from profiling import profiled
+from utilities import WavelengthIndex, window_intensities
+
+table_points = 4096
+newton_steps = 1  # from the table a single step is accurate to ~1e-8 K
+readout_block = 1 << 20  # values converted at once, keeps the temporaries of the Newton steps small
+
+
+class Calibration:
+    """Fitted calibration curve stored as a JSON artifact and inverted from thermometric parameter to temperature.
+    The curve is tabulated over the fitted temperature range; the table gives the starting temperatures of a few
+    vectorized Newton steps and the calibration part of the temperature uncertainty."""
+    def __init__(self, model, parameters, covariance, first_line_position, second_line_position, temperature_range,
+                 points=table_points, band_widths=None):
+        self.model = model
+        self.parameters = np.asarray(parameters, dtype=np.float64)
+        self.covariance = np.asarray(covariance, dtype=np.float64)
+        self.first_line_position = first_line_position
+        self.second_line_position = second_line_position
+        # maps recorded while cooling give a descending fit range
+        self.temperature_range = (float(min(temperature_range)), float(max(temperature_range)))
+        self.band_widths = None if band_widths is None else tuple(band_widths)
+        self.function = dict_of_fitting_functions[model]
+        self.derivative = dict_of_temperature_derivatives[model]
+        self.build_table(points)
+
+    @classmethod
+    def from_analysis(cls, analysis, points=table_points):
+        return cls(analysis.model, analysis.fitted_output_parameters, analysis.covariance,
+                   analysis.first_line_position, analysis.second_line_position,
+                   (analysis.fit_x[0], analysis.fit_x[-1]), points, analysis.band_widths)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path) as file:
+            artifact = json.load(file)
+        return cls(artifact['model'], artifact['parameters'], artifact['covariance'], artifact['first'],
+                   artifact['second'], artifact['temperature_range'], artifact.get('table_points', table_points),
+                   artifact.get('band_widths'))
+
+    def save(self, file_path):
+        artifact = {
+            'model': self.model,
+            'parameters': self.parameters.tolist(),
+            'covariance': self.covariance.tolist(),
+            'first': self.first_line_position,
+            'second': self.second_line_position,
+            'temperature_range': list(self.temperature_range),
+            'table_points': len(self.table_temperatures)
+        }
+        if self.band_widths is not None:
+            artifact['band_widths'] = list(self.band_widths)
+        with open(file_path, 'w') as file:
+            json.dump(artifact, file, indent=1)
+        return file_path
+
+    def build_table(self, points):
+        temperatures = np.linspace(*self.temperature_range, points)
+        values = self.function(temperatures, *self.parameters)
+        derivatives = self.derivative(temperatures, *self.parameters)
+        if not (np.all(derivatives > 0) or np.all(derivatives < 0)):
+            raise ValueError(f'The {self.model} calibration is not monotonic between {self.temperature_range[0]:g} K '
+                             f'and {self.temperature_range[1]:g} K and cannot be inverted')
+        jacobian = dict_of_fitting_jacobians[self.model](temperatures, *self.parameters)
+        value_error = np.sqrt(np.maximum(np.einsum('tp,pq,tq->t', jacobian, self.covariance, jacobian), 0.0))
+        # np.interp needs increasing sample points
+        order = slice(None) if derivatives[0] > 0 else slice(None, None, -1)
+        self.table_values = values[order]
+        self.table_temperatures = temperatures[order]
+        self.table_errors = value_error / np.abs(derivatives)  # by increasing temperature
+
+    def _temperature_block(self, values, value_errors):
+        inside = (values >= self.table_values[0]) & (values <= self.table_values[-1])
+        temperatures = np.interp(values, self.table_values, self.table_temperatures)
+        low, high = self.temperature_range
+        with np.errstate(all='ignore'):
+            for _ in range(newton_steps):
+                derivatives = self.derivative(temperatures, *self.parameters)
+                temperatures = temperatures - (self.function(temperatures, *self.parameters) - values) / derivatives
+                np.clip(temperatures, low, high, out=temperatures)
+            temperatures[~inside] = np.nan
+            errors = np.interp(temperatures, np.linspace(low, high, len(self.table_errors)), self.table_errors)
+            if value_errors is not None:
+                errors = np.hypot(errors, value_errors / self.derivative(temperatures, *self.parameters))
+        errors[~inside] = np.nan
+        return temperatures, errors
+
+    @profiled('readout.temperature')
+    def temperature(self, values, value_errors=None):
+        """Temperatures and their uncertainties for an array of thermometric parameters. The uncertainty combines
+        the calibration (parameter covariance) with value_errors, the absolute errors of the values, if given.
+        Values outside the calibrated range give NaN."""
+        values = np.asarray(values, dtype=np.float64)
+        flat_values = values.ravel()
+        flat_value_errors = None
+        if value_errors is not None:
+            flat_value_errors = np.broadcast_to(np.asarray(value_errors, dtype=np.float64), values.shape).ravel()
+        temperatures = np.empty_like(flat_values)
+        errors = np.empty_like(flat_values)
+        for start in range(0, len(flat_values), readout_block):
+            block = slice(start, start + readout_block)
+            temperatures[block], errors[block] = self._temperature_block(
+                flat_values[block], None if flat_value_errors is None else flat_value_errors[block])
+        return temperatures.reshape(values.shape), errors.reshape(values.shape)
+
+    def bands(self):
+        if self.band_widths is None:
+            return None
+        return tuple((position - width / 2, position + width / 2) for position, width
+                     in zip((self.first_line_position, self.second_line_position), self.band_widths))
+
+    def thermometric_parameter(self, x_data, spectra):
+        """Ratio of the calibration lines, or of the calibration bands, in (wavelengths x spectra) intensities. Lines
+        and window edges between axis points are interpolated, a band of zero width is taken at its line."""
+        index = WavelengthIndex(np.asarray(x_data, dtype=np.float64))
+        if self.band_widths is None:
+            first_row, second_row = index.interpolate([self.first_line_position, self.second_line_position], spectra)
+            return first_row / second_row
+        cumulative = cumulative_trapezoid(spectra, index.x_data, axis=0, initial=0)
+        first_integral, second_integral = window_intensities(index, spectra, cumulative, self.bands())
+        return first_integral / second_integral
+
+    def read_out(self, x_data, spectra, value_errors=None):
+        return self.temperature(self.thermometric_parameter(x_data, spectra), value_errors)
+
+    def read_out_map(self, thermmap):
+        """Temperatures and uncertainties of every spectrum of a map; the temperatures stored with the map are
+        not used."""
+        if self.band_widths is not None:
+            return self.temperature(thermmap.band_ratio(*self.bands()))
+        first_row, second_row = thermmap.get_rows_of_ydata([self.first_line_position, self.second_line_position],
+                                                           interpolate=True)
+        return self.temperature(first_row / second_row)
+
+
+def calibrate(file_path, first_line_position, second_line_position, model, initial_parameters=None, band_widths=None):
+    from pipeline import Analysis, open_thermmap
+    analysis = Analysis(open_thermmap(file_path), first_line_position, second_line_position, band_widths)
+    analysis.fit(model, initial_parameters)
+    return Calibration.from_analysis(analysis)
+
+
+def read_values(file_path):
+    """Thermometric parameters stored in a .npy file or the first array of a .npz file."""
+    values = np.load(file_path)
+    if isinstance(values, np.lib.npyio.NpzFile):
+        values = values[values.files[0]]
+    return values
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Convert spectra or thermometric parameters to temperatures with a stored calibration.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    save_parser = subparsers.add_parser('save', help='fit a calibration map and store the calibration')
+    save_parser.add_argument('source', help='spectrometer export or converted .hdf5 map of the calibration')
+    save_parser.add_argument('calibration', help='JSON file to write')
+    save_parser.add_argument('--first', type=float, required=True, help='numerator wavelength / nm')
+    save_parser.add_argument('--second', type=float, required=True, help='denominator wavelength / nm')
+    save_parser.add_argument('--band-width', nargs='+', type=float, default=None, metavar='WIDTH',
+                             help='integrate windows of this width / nm around the lines; a second value sets the denominator window')
+    save_parser.add_argument('--model', default='Single Mott-Seitz', choices=list(dict_of_fitting_functions))
+    save_parser.add_argument('--initial', nargs='*', type=float, default=None, help='starting value of every model parameter')
+    convert_parser = subparsers.add_parser('convert', help='convert spectra or thermometric parameters to temperatures')
+    convert_parser.add_argument('calibration', help='JSON file written by "save"')
+    convert_parser.add_argument('sources', nargs='+', help='maps (.hdf5 or spectrometer export) or .npy/.npz parameter arrays')
+    convert_parser.add_argument('--output', default=None, help='directory of the .npz results (default: next to the source)')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == 'save':
+        band_widths = None
+        if arguments.band_width:
+            band_widths = (arguments.band_width[0], arguments.band_width[-1])
+        calibration = calibrate(arguments.source, arguments.first, arguments.second, arguments.model, arguments.initial,
+                                band_widths)
+        calibration.save(arguments.calibration)
+        low, high = calibration.temperature_range
+        print(f'{arguments.calibration}: {calibration.model} {calibration.parameters.tolist()}, {low:g}-{high:g} K')
+        return 0
+
+    from pipeline import open_thermmap
+    calibration = Calibration.load(arguments.calibration)
+    exit_code = 0
+    for source in arguments.sources:
+        try:
+            if source.endswith(('.npy', '.npz')):
+                temperatures, errors = calibration.temperature(read_values(source))
+            else:
+                temperatures, errors = calibration.read_out_map(open_thermmap(source))
+        except Exception as e:
+            print(f'{source}: FAILED {type(e).__name__}: {e}')
+            exit_code = 1
+            continue
+        directory = path.dirname(source) if arguments.output is None else arguments.output
+        output_path = path.join(directory, f'{path.splitext(path.basename(source))[0]} temperatures.npz')
+        np.savez(output_path, temperature=temperatures, temperature_error=errors)
+        outside = int(np.isnan(temperatures).sum())
+        print(f'{source}: {temperatures.size} values, {outside} outside the calibration -> {output_path}')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import numpy as np
+
+from fitting_functions import dict_of_fitting_functions, dict_of_temperature_derivatives
+from profiling import profiled
+
+relative_step = 1e-6
+
+
+@profiled('sensitivity.relative_sensitivity')
+def relative_sensitivity(model, temperatures, parameters):
+    """Sr = |d(Delta)/dT| / Delta * 100 in % K^-1, from the analytic temperature derivative of the model."""
+    temperatures = np.asarray(temperatures, dtype=np.float64)
+    value = dict_of_fitting_functions[model](temperatures, *parameters)
+    derivative = dict_of_temperature_derivatives[model](temperatures, *parameters)
+    return np.abs(derivative / value) * 100
+
+
+@profiled('sensitivity.relative_sensitivity_error')
+def relative_sensitivity_error(model, temperatures, parameters, covariance):
+    """Uncertainty of Sr propagated from the parameter covariance. The derivatives of Sr with respect to the
+    parameters are central differences evaluated for all temperatures at once."""
+    parameters = np.asarray(parameters, dtype=np.float64)
+    steps = relative_step * np.maximum(np.abs(parameters), 1.0)
+    gradient = np.empty((len(np.atleast_1d(temperatures)), len(parameters)))
+    for index, step in enumerate(steps):
+        shift = np.zeros_like(parameters)
+        shift[index] = step
+        gradient[:, index] = (relative_sensitivity(model, temperatures, parameters + shift) -
+                              relative_sensitivity(model, temperatures, parameters - shift)) / (2 * step)
+    variance = np.einsum('tp,pq,tq->t', gradient, covariance, gradient)
+    error = np.sqrt(np.maximum(variance, 0.0))
+    return error if np.ndim(temperatures) else error[0]
@@ -0,0 +1,85 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import cpu_count
+
+import numpy as np
+from scipy.signal import savgol_coeffs, savgol_filter
+
+progress_block_columns = 16  # columns smoothed between two progress reports
+
+
+@lru_cache(maxsize=32)
+def savgol_kernel(window_length, polyorder, delta=1):
+    """Interior coefficients and the edge matrices that reproduce savgol_filter(mode='interp'), where the first and
+    last half windows are taken from a polynomial fitted to the first and last full window."""
+    coefficients = savgol_coeffs(window_length, polyorder, deriv=0, delta=delta, use='dot')
+    half_length = window_length // 2
+    vandermonde = np.vander(np.arange(window_length, dtype=np.float64), polyorder + 1)
+    projection = vandermonde @ np.linalg.pinv(vandermonde)
+    return coefficients, projection[:half_length], projection[window_length - half_length:]
+
+
+def _apply_kernel(y_data, out, window_length, polyorder, delta):
+    coefficients, left_edge, right_edge = savgol_kernel(window_length, polyorder, delta)
+    half_length = window_length // 2
+    interior_length = y_data.shape[0] - window_length + 1
+    interior = out[half_length:half_length + interior_length]
+    np.multiply(y_data[:interior_length], coefficients[0], out=interior)
+    buffer = np.empty_like(interior)
+    for shift in range(1, window_length):
+        np.multiply(y_data[shift:shift + interior_length], coefficients[shift], out=buffer)
+        interior += buffer
+    np.matmul(left_edge, y_data[:window_length], out=out[:half_length])
+    np.matmul(right_edge, y_data[-window_length:], out=out[-half_length:])
+
+
+def savgol_smooth(y_data, window_length, polyorder, delta=1, workers=1, out=None, progress=None):
+    """Savitzky-Golay smoothing of every column of y_data along the wavelength axis (axis 0) at once. With workers > 1
+    the temperature columns are split between threads, all writing into the same preallocated output. With progress
+    the columns are smoothed in blocks and progress(fraction) is called after each one; an exception raised by it
+    stops the smoothing."""
+    y_data = np.asarray(y_data, dtype=np.float64)
+    if out is None:
+        out = np.empty_like(y_data)
+    if window_length % 2 == 0 or window_length == 1 or window_length > y_data.shape[0]:
+        # the precomputed kernel assumes an odd window centred on each point; leave the rest to scipy
+        out[...] = savgol_filter(y_data, window_length=window_length, polyorder=polyorder, delta=delta, deriv=0, axis=0)
+        return out
+    if workers is None:
+        workers = cpu_count() or 1
+    workers = max(1, min(workers, y_data.shape[1]))
+    number_of_blocks = workers
+    if progress is not None:
+        number_of_blocks = max(workers, -(-y_data.shape[1] // progress_block_columns))
+    blocks = [(block[0], block[-1] + 1) for block in np.array_split(np.arange(y_data.shape[1]), number_of_blocks)]
+    if workers == 1:
+        for index, (start, stop) in enumerate(blocks):
+            _apply_kernel(y_data[:, start:stop], out[:, start:stop], window_length, polyorder, delta)
+            if progress is not None:
+                progress((index + 1) / len(blocks))
+        return out
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_apply_kernel, y_data[:, start:stop], out[:, start:stop], window_length, polyorder,
+                                   delta) for start, stop in blocks]
+        try:
+            for index, future in enumerate(futures):
+                future.result()
+                if progress is not None:
+                    progress((index + 1) / len(blocks))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return out
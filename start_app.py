@@ -10,37 +10,91 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
+from time import perf_counter, time
+launch_time = perf_counter()  # before the GUI imports, which are a large part of the startup time
+
+import argparse
 import sys
-from gui import run_gui
-from PyQt6.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QPushButton
+from multiprocessing import freeze_support
+from gui import run_gui, settings
+from tasks import TaskRunner
+from PyQt6.QtWidgets import QWidget, QVBoxLayout, QLabel, QPushButton
 from PyQt6.QtGui import QIcon
-import requests #type: ignore
 from webbrowser import open
 
-class Launcher(QApplication):
+release = "1.0.5" #VERSION
+releases_url = "https://api.github.com/repos/HubertCo22bpdo/ThermLUM/releases"
+update_check_timeout = 3  # s, offline machines must not hold up anything for longer
+update_check_interval = 24 * 3600  # s between checks, the last result is kept in settings.json meanwhile
+
+
+def fetch_latest_release(timeout=update_check_timeout):
+    import requests #type: ignore
+    response = requests.get(releases_url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()[0]["tag_name"]
+
+
+class UpdateNotice(QWidget):
     """Checks if installed ThermLUM version is actual. Helps install the latest version. Credit to relACs:  
     """
-    def __init__(self, sys_argv:list[str]):
-        super(Launcher, self).__init__(sys_argv)
-        self.window = QWidget()
-        app_icon: QIcon = QIcon(r'.\icon\app_icon.tiff')
-        Launcher.setWindowIcon(app_icon)
+    def __init__(self, latest_release):
+        super(UpdateNotice, self).__init__()
+        self.setWindowIcon(QIcon(r'.\icon\app_icon.tiff'))
         launcher_layout = QVBoxLayout()
-        launcher_layout.addWidget(QLabel(f"New ThermLUM version {latest_relase} is available."))
+        launcher_layout.addWidget(QLabel(f"New ThermLUM version {latest_release} is available."))
         install_button = QPushButton("Install new version")
-        install_button.clicked.connect(lambda: open(f"https://github.com/HubertCo22bpdo/ThermLUM/tag/{latest_relase}")) #type: ignore
+        install_button.clicked.connect(lambda: open(f"https://github.com/HubertCo22bpdo/ThermLUM/tag/{latest_release}")) #type: ignore
         skip_button: QPushButton = QPushButton("Continue using old version")
-        skip_button.clicked.connect(Launcher.closeAllWindows) #type: ignore
+        skip_button.clicked.connect(self.close) #type: ignore
         launcher_layout.addWidget(install_button)
         launcher_layout.addWidget(skip_button)
-        self.window.setLayout(launcher_layout)
-        self.window.show()
-
-response = requests.get("https://api.github.com/repos/HubertCo22bpdo/ThermLUM/releases")
-if response.ok:
-    release = "1.0.5" #VERSION
-    latest_relase= response.json()[0]["tag_name"]
-    if latest_relase != release:
-        launcher = Launcher(sys.argv)
-        launcher.exec()
-run_gui()
+        self.setLayout(launcher_layout)
+
+
+class UpdateChecker(TaskRunner):
+    """Shows the last known release right away and refreshes it in the background once the cached result is older
+    than update_check_interval, so neither a slow nor a missing network delays the start."""
+    def __init__(self, parent=None):
+        super(UpdateChecker, self).__init__(parent)
+        self.notice = None
+
+    def start(self):
+        self.notify(settings.get('latest_release'))
+        if time() - settings.get('update_checked_at', 0) > update_check_interval:
+            self.submit('update', fetch_latest_release, on_finished=self.on_checked, on_failed=lambda _: None)
+
+    def on_checked(self, latest_release):
+        settings['latest_release'] = latest_release
+        settings['update_checked_at'] = time()
+        self.notify(latest_release)
+
+    def notify(self, latest_release):
+        if latest_release is None or latest_release == release or self.notice is not None:
+            return
+        self.notice = UpdateNotice(latest_release)
+        self.notice.show()
+
+
+def start_update_check(app):
+    checker = UpdateChecker(app)
+    checker.start()
+    return checker
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='ThermLUM luminescent thermometry data analysis.')
+    parser.add_argument('--startup-time', default=None, metavar='FILE',
+                        help='open FILE, print the time until the main window is shown and quit')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.startup_time is not None:
+        run_gui(file_path=arguments.startup_time, startup_time=launch_time)
+    else:
+        run_gui(on_start=start_update_check)
+    return 0
+
+
+if __name__ == '__main__':
+    freeze_support()  # worker processes of the frozen application must not start the GUI again
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+import logging
+
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, QEventLoop, Qt, pyqtSignal
+from PyQt6.QtWidgets import QProgressDialog
+
+logger = logging.getLogger(__name__)
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class TaskSignals(QObject):
+    progress = pyqtSignal(float)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    cancelled = pyqtSignal()
+
+
+class Task(QRunnable):
+    """Runs function(*args, **kwargs) on a pool thread. With with_progress the function receives a progress(fraction)
+    callback, which also raises TaskCancelled once the task was cancelled, so long operations stop early."""
+    def __init__(self, function, *args, with_progress=False, **kwargs):
+        super(Task, self).__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        if with_progress:
+            self.kwargs['progress'] = self.report_progress
+        self.signals = TaskSignals()
+        self.is_cancelled = False
+        # the runner keeps its own reference and may still dequeue the task, so Qt must not delete it
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def report_progress(self, fraction):
+        if self.is_cancelled:
+            raise TaskCancelled()
+        self.signals.progress.emit(fraction)
+
+    def run(self):
+        if self.is_cancelled:
+            self.signals.cancelled.emit()
+            return
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except TaskCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            logger.debug('Task %s failed', getattr(self.function, '__qualname__', self.function), exc_info=e)
+            self.signals.failed.emit(e)
+        else:
+            if self.is_cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(result)
+
+
+class TaskRunner(QObject):
+    """Submits tasks to a thread pool. Submitting a task under a key that already has a pending task supersedes it:
+    the old task is cancelled or dequeued and its result, if it still arrives, is dropped."""
+    def __init__(self, parent=None, pool=None):
+        super(TaskRunner, self).__init__(parent)
+        self.pool = QThreadPool.globalInstance() if pool is None else pool
+        self.tasks = {}
+        self.alive = set()  # superseded tasks still running on the pool need a Python reference until they end
+
+    def submit(self, key, function, *args, on_finished=None, on_failed=None, on_progress=None, with_progress=False,
+               **kwargs):
+        self.cancel(key)
+        task = Task(function, *args, with_progress=with_progress, **kwargs)
+        self.tasks[key] = task
+        self.alive.add(task)
+        task.signals.finished.connect(lambda result: self._finish(key, task, on_finished, result))
+        task.signals.failed.connect(lambda error: self._finish(key, task, on_failed, error))
+        task.signals.cancelled.connect(lambda: self._finish(key, task, None, None))
+        if on_progress is not None:
+            task.signals.progress.connect(lambda fraction: self._progress(key, task, on_progress, fraction))
+        self.pool.start(task)
+        return task
+
+    def _progress(self, key, task, callback, fraction):
+        if self.tasks.get(key) is task:
+            callback(fraction)
+
+    def _finish(self, key, task, callback, value):
+        self.alive.discard(task)
+        if self.tasks.get(key) is not task:
+            return
+        del self.tasks[key]
+        if callback is not None:
+            callback(value)
+
+    def cancel(self, key):
+        task = self.tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+            if self.pool.tryTake(task):
+                self.alive.discard(task)
+
+    def is_running(self, key):
+        return key in self.tasks
+
+    def run_with_progress(self, key, label, function, *args, parent=None, with_progress=False, **kwargs):
+        """Runs a task while a modal progress dialog keeps the event loop alive and returns its result. Raises
+        TaskCancelled when the user cancels and re-raises the task's exception when it fails."""
+        outcome = {}
+        loop = QEventLoop()
+        dialog = QProgressDialog(label, 'Cancel', 0, 1000, parent)
+        dialog.setWindowModality(Qt.WindowModality.ApplicationModal)
+        dialog.setMinimumDuration(300)
+        dialog.setAutoClose(False)
+
+        def store(name):
+            def callback(value):
+                outcome[name] = value
+                loop.quit()
+            return callback
+
+        def cancel():
+            self.cancel(key)
+            loop.quit()
+
+        dialog.canceled.connect(cancel)
+        task = self.submit(key, function, *args, on_finished=store('result'), on_failed=store('error'),
+                           on_progress=lambda fraction: dialog.setValue(int(fraction * 1000)),
+                           with_progress=with_progress, **kwargs)
+        task.signals.cancelled.connect(loop.quit)
+        loop.exec()
+        dialog.canceled.disconnect(cancel)
+        dialog.close()
+        if 'error' in outcome:
+            raise outcome['error']
+        if 'result' not in outcome:
+            raise TaskCancelled()
+        return outcome['result']
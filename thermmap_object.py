@@ -12,69 +12,280 @@
 # GNU General Public License for more details.
 import h5py
 from os import path
-from scipy.signal import savgol_filter
 
 import numpy as np
+from scipy.integrate import cumulative_trapezoid
+
+from creation import block_rows
+from derived_cache import DerivedCache, default_max_bytes, hash_map, map_hasher, hash_update, finish_map_hash
+from lod import SpectralPyramid, build_levels, level_factor, min_level_rows
+from profiling import profiled
+from smoothing import savgol_smooth
+from utilities import WavelengthIndex, window_intensities
 
 
 class ThermMap:
-    def __init__(self, hdf_file_path):
+    def __init__(self, hdf_file_path, name=None, cache_max_bytes=default_max_bytes):
         self.file = h5py.File(hdf_file_path, 'r+')
         file_directory, file_name = path.split(hdf_file_path)
-        self.name = file_name[:-5]
+        self.name = file_name[:-5] if name is None else name
         self.directory = file_directory
         self.data = None
+        self.x_data = None
+        self.wavelength_index = None
+        self.resolution = None
         self.temperatures = None
+        self.cumulative = None
+        self.cache_max_bytes = cache_max_bytes
+        self._cache = None
+
+    @property
+    def dataset(self):
+        return self.file[self.name][f'data_{self.name}']
 
-    def get_data(self):
-        self.data = self.file[self.name][f'data_{self.name}'][...]
+    @profiled()
+    def get_data(self, memory_map=False):
+        # a memory-mapped contiguous dataset is paged in by the OS on access instead of being read up front
+        self.data = self.memory_map() if memory_map else None
+        if self.data is None:
+            self.data = self.dataset[...]
         self.x_data = self.data[:, 0].astype(np.float64)
-        self.resolution = abs(self.data[-1, 0] - self.data[-2, 0])
+        self.wavelength_index = WavelengthIndex(self.x_data)
+        self.resolution = self.wavelength_index.resolution
         return self.data
 
+    def get_x_data(self):
+        if self.x_data is None:
+            self.x_data = self.dataset[:, 0].astype(np.float64)
+            self.wavelength_index = WavelengthIndex(self.x_data)
+            self.resolution = self.wavelength_index.resolution
+        return self.x_data
+
+    @profiled()
     def get_temperatures(self):
         self.temperatures = self.file[self.name][f'temperatures_{self.name}'][...].astype(np.float64)
         return self.temperatures
 
+    @profiled()
+    def get_rows(self, indices):
+        """Intensities of the given wavelength rows, read from the file chunks holding them if the map is not loaded."""
+        indices = np.atleast_1d(indices)
+        if self.data is not None:
+            return self.data[indices, 1:]
+        # h5py selections have to be increasing and unique
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        return self.dataset[unique_indices, 1:][inverse]
+
+    def get_column(self, temperature_index):
+        if self.data is not None:
+            return self.data[:, temperature_index + 1]
+        return self.dataset[:, temperature_index + 1]
+
+    @profiled()
+    def get_region(self, first_row, last_row, first_temperature_index=0, last_temperature_index=None):
+        columns = slice(first_temperature_index + 1, None if last_temperature_index is None else last_temperature_index + 2)
+        if self.data is not None:
+            return self.data[first_row:last_row + 1, columns]
+        return self.dataset[first_row:last_row + 1, columns]
+
+    def memory_map(self):
+        dataset = self.dataset
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or dataset.compression is not None or offset is None:
+            return None
+        return np.memmap(self.file.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+    @profiled()
+    def make_contiguous(self, rows_per_block=block_rows):
+        """Rewrites the map with a contiguous layout so it can be memory-mapped. Contiguous maps cannot be resized."""
+        source = self.dataset
+        if source.chunks is None:
+            return
+        group = self.file[self.name]
+        target = group.create_dataset(f'contiguous_data_{self.name}', shape=source.shape, dtype=source.dtype)
+        for key, value in source.attrs.items():
+            target.attrs[key] = value
+        for start in range(0, source.shape[0], rows_per_block):
+            target[start:start + rows_per_block] = source[start:start + rows_per_block]
+        del group[f'data_{self.name}']
+        group.move(f'contiguous_data_{self.name}', f'data_{self.name}')
+        self.file.flush()
+
     def get_row_of_ydata(self, x_value):
-            if self.data is None:
-                self.get_data()
-            for index, value in enumerate(self.x_data):
-                if value == x_value:
-                    row = self.data[index, 1:]
-                    return row
-    
+        self.get_x_data()
+        index = self.wavelength_index.find(x_value)
+        if index >= 0:
+            return self.get_rows(index)[0]
+
+    def get_rows_of_ydata(self, x_values, interpolate=False):
+        self.get_x_data()
+        if interpolate:
+            lower, upper, weight = self.wavelength_index.interpolation_weights(x_values)
+            return (1 - weight)[:, np.newaxis] * self.get_rows(lower) + weight[:, np.newaxis] * self.get_rows(upper)
+        indices = self.wavelength_index.find(x_values)
+        if np.any(indices < 0):
+            raise KeyError(f'Wavelengths {np.asarray(x_values)[indices < 0]} are not on the wavelength axis')
+        return self.get_rows(indices)
+
     @staticmethod
     def general_get_row_of_ydata(data, x_value):
-            x_data = data[:, 0].astype(np.float64)
-            for index, value in enumerate(x_data):
-                if value == x_value:
-                    row = data[index, 1:]
-                    return row
+        index = WavelengthIndex(data[:, 0]).find(x_value)
+        if index >= 0:
+            return data[index, 1:]
+
+    @property
+    def source_hash(self):
+        dataset = self.dataset
+        if 'source_hash' not in dataset.attrs:
+            dataset.attrs['source_hash'] = hash_map(dataset, self.get_temperatures())
+        return dataset.attrs['source_hash']
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = DerivedCache(self.file[self.name], self.source_hash, self.cache_max_bytes)
+        return self._cache
+
+    @profiled()
+    def append_temperatures(self, temperatures, columns):
+        """Appends (wavelengths x new temperatures) columns measured on the map's wavelengths. Only the new columns
+        are written and hashed: the new source hash chains the previous one with them, so the cost does not grow
+        with the size of the map. Derived results of the previous data stop matching and are dropped on the next
+        cache access."""
+        dataset = self.dataset
+        if dataset.chunks is None:
+            raise ValueError(f'{self.name} is stored contiguously and cannot grow, convert it again to append scans')
+        temperatures = np.atleast_1d(np.asarray(temperatures, dtype=np.float64))
+        columns = np.asarray(columns, dtype=np.float64).reshape(dataset.shape[0], len(temperatures))
+        previous_hash = self.source_hash
+        temperatures_dataset = self.file[self.name][f'temperatures_{self.name}']
+        start = dataset.shape[1]
+        dataset.resize(start + len(temperatures), axis=1)
+        dataset[:, start:] = columns
+        temperatures_dataset.resize(start - 1 + len(temperatures), axis=0)
+        temperatures_dataset[start - 1:] = temperatures
+        self.temperatures = temperatures_dataset[...].astype(np.float64)
+
+        hasher = map_hasher()
+        hasher.update(previous_hash.encode())
+        hash_update(hasher, columns)
+        dataset.attrs['source_hash'] = finish_map_hash(hasher, dataset.shape, temperatures)
+        self._cache = None
+        self.cumulative = None
+        if self.data is not None:
+            self.data = None
+            self.get_data()
+        return start - 1
 
+    def invalidate_derived(self):
+        """Has to be called whenever the raw data of the map changes."""
+        if 'source_hash' in self.dataset.attrs:
+            del self.dataset.attrs['source_hash']
+        self.data = None
+        self.x_data = None
+        self.temperatures = None
+        self.cumulative = None
+        self._cache = None
+        self.cache.invalidate()
+
+    @profiled()
+    def pyramid(self, factor=level_factor, min_rows=min_level_rows):
+        """Min/max level-of-detail pyramid of the map. The levels are kept in the derived cache, so they are built once
+        per raw data and rebuilt automatically when it changes."""
+        if self.data is None:
+            self.get_data()
+        parameters = {'factor': factor, 'min_rows': min_rows}
+        cached = self.cache.get('pyramid', parameters)
+        if cached is not None:
+            levels = {int(name.split('_')[1]): level for name, level in cached.items()}
+        else:
+            levels = build_levels(self.data, factor, min_rows)
+            self.cache.put('pyramid', parameters, **{f'level_{bin_size}': level for bin_size, level in levels.items()})
+        return SpectralPyramid(self.data, levels)
+
+    @profiled()
     def normalize(self, normalization_value, save=False):
+        if self.data is None:
+            self.get_data()
+        parameters = {'normalization_value': self.wavelength_index.quantize(normalization_value)}
+        cached = self.cache.get('normalize', parameters)
+        if cached is not None:
+            return cached['normalized_data']
         normalization_row = self.get_row_of_ydata(normalization_value)
-        normalized_data = np.vstack((self.x_data, (self.data[:, 1:] / normalization_row).T)).T
+        normalized_data = np.empty(self.data.shape, dtype=np.float64)
+        normalized_data[:, 0] = self.x_data
+        np.divide(self.data[:, 1:], normalization_row, out=normalized_data[:, 1:])
         if save:
-            try:
-                self.file[self.name][f'data_{self.name}_normalized_to_{normalization_value}'] = normalized_data
-            except Exception as e:
-                print(e)
+            self.cache.put('normalize', parameters, normalized_data=normalized_data)
         return normalized_data
             
-    def smooth(self, window_length, polyorder, delta=1, save=False):
+    @profiled()
+    def smooth(self, window_length, polyorder, delta=1, save=False, workers=1, progress=None):
         if self.data is None:
             self.get_data()
         if self.temperatures is None:
             self.get_temperatures()
-        smoothed_data = self.data.copy()
-        for index, column in enumerate(smoothed_data[:, 1:].T):
-            smoothed_data[:, index + 1] = savgol_filter(column, window_length=window_length, polyorder=polyorder, delta=delta, deriv=0)
-        smooth_residual =  np.vstack((self.x_data, (smoothed_data[:, 1:] - self.data[:, 1:]).T)).T
+        parameters = {'window_length': window_length, 'polyorder': polyorder, 'delta': delta}
+        cached = self.cache.get('smooth', parameters)
+        if cached is not None:
+            return cached['smoothed_data'], cached['smooth_residual']
+        smoothed_data = np.empty(self.data.shape, dtype=np.float64)
+        smooth_residual = np.empty(self.data.shape, dtype=np.float64)
+        smoothed_data[:, 0] = smooth_residual[:, 0] = self.x_data
+        savgol_smooth(self.data[:, 1:], window_length=window_length, polyorder=polyorder, delta=delta,
+                      workers=workers, out=smoothed_data[:, 1:], progress=progress)
+        np.subtract(smoothed_data[:, 1:], self.data[:, 1:], out=smooth_residual[:, 1:])
         if save:
-            try:
-                self.file[self.name][f'data_{self.name}_smoothed'] = smoothed_data
-                self.file[self.name][f'smooth_residuals_{self.name}'] = smooth_residual
-            except Exception as e:
-                print(e)
+            self.cache.put('smooth', parameters, smoothed_data=smoothed_data, smooth_residual=smooth_residual)
         return smoothed_data, smooth_residual
+
+    @profiled()
+    def ratio(self, first_x_value, second_x_value, save=False):
+        self.get_x_data()
+        parameters = {'first': self.wavelength_index.quantize(first_x_value),
+                      'second': self.wavelength_index.quantize(second_x_value)}
+        cached = self.cache.get('ratio', parameters)
+        if cached is not None:
+            return cached['thermometric_parameter']
+        first_row, second_row = self.get_rows_of_ydata([first_x_value, second_x_value])
+        thermometric_parameter = first_row / second_row
+        if save:
+            self.cache.put('ratio', parameters, thermometric_parameter=thermometric_parameter)
+        return thermometric_parameter
+
+    @profiled()
+    def cumulative_integral(self):
+        """Cumulative trapezoid integral of every spectrum along the wavelength axis, (wavelengths x temperatures). It
+        is kept in the derived cache, so the integral over any wavelength window takes two interpolations per
+        temperature. The array is also kept in memory, so dragging a window does not touch the file."""
+        if self.cumulative is not None:
+            return self.cumulative
+        if self.data is None:
+            self.get_data()
+        cached = self.cache.get('cumulative_integral', {})
+        if cached is not None:
+            self.cumulative = cached['cumulative_integral']
+        else:
+            self.cumulative = cumulative_trapezoid(self.data[:, 1:], self.x_data, axis=0, initial=0)
+            self.cache.put('cumulative_integral', {}, cumulative_integral=self.cumulative)
+        return self.cumulative
+
+    def band_integrals(self, bands):
+        """Integrated intensities of (start, end) wavelength windows, (windows x temperatures). Window edges between
+        axis points are interpolated; a window of zero width gives the intensity at its wavelength."""
+        cumulative = self.cumulative_integral()
+        return window_intensities(self.wavelength_index, self.data[:, 1:], cumulative, bands)
+
+    @profiled()
+    def band_ratio(self, first_band, second_band, save=False):
+        """Ratio of the intensities integrated over two (start, end) wavelength windows."""
+        parameters = {'first': [float(value) for value in first_band],
+                      'second': [float(value) for value in second_band]}
+        cached = self.cache.get('band_ratio', parameters)
+        if cached is not None:
+            return cached['thermometric_parameter']
+        first_integral, second_integral = self.band_integrals([first_band, second_band])
+        thermometric_parameter = first_integral / second_integral
+        if save:
+            self.cache.put('band_ratio', parameters, thermometric_parameter=thermometric_parameter)
+        return thermometric_parameter
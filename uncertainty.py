@@ -0,0 +1,157 @@
+# ThermLUM - luminescent thermometry data analysis application
+# Copyright (C) 2024  Hubert Dzielak
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+import numpy as np
+
+from fitting import fit_model
+from fitting_functions import dict_of_fitting_functions, dict_of_temperature_derivatives
+from profiling import profiled
+from sensitivity import relative_sensitivity
+
+noise_half_width = 10  # rows on each side of a line whose residuals describe the noise at that line
+samples_per_batch = 64
+newton_iterations = 50
+newton_tolerance = 1e-6  # K
+
+
+def local_residuals(residual, row_index, half_width=noise_half_width):
+    """Residual rows (data - smooth) around row_index, shape (rows x temperatures)."""
+    return -residual[max(row_index - half_width, 0):row_index + half_width + 1, 1:]
+
+
+def draw_noise(residuals, number_of_samples, rng, noise='bootstrap'):
+    """(samples x temperatures) noise. 'bootstrap' resamples the local residuals of every temperature, 'gaussian'
+    draws from a normal distribution with their standard deviation."""
+    if noise == 'gaussian':
+        return rng.normal(0.0, np.std(residuals, axis=0, ddof=1), (number_of_samples, residuals.shape[1]))
+    if noise == 'bootstrap':
+        rows = rng.integers(0, residuals.shape[0], (number_of_samples, residuals.shape[1]))
+        return residuals[rows, np.arange(residuals.shape[1])]
+    raise ValueError(f'Unknown noise model {noise!r}')
+
+
+def _fit_batch(model, temperatures, ratios, initial_parameters, fixed_parameters):
+    parameters = np.full((len(ratios), len(initial_parameters)), np.nan)
+    for index, ratio in enumerate(ratios):
+        try:
+            parameters[index] = fit_model(model, temperatures, ratio, initial_parameters, fixed_parameters)[0]
+        except (RuntimeError, ValueError):
+            pass
+    return parameters
+
+
+def refit(model, temperatures, ratios, initial_parameters, fixed_parameters=None, workers=None):
+    """Fits every row of ratios, starting from initial_parameters, in batches over a process pool. Rows that do not
+    converge are NaN."""
+    batches = [ratios[start:start + samples_per_batch] for start in range(0, len(ratios), samples_per_batch)]
+    if workers is None:
+        workers = cpu_count() or 1
+    if workers == 1 or len(batches) == 1:
+        return np.concatenate([_fit_batch(model, temperatures, batch, initial_parameters, fixed_parameters)
+                               for batch in batches])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_fit_batch, *zip(*[(model, temperatures, batch, initial_parameters, fixed_parameters)
+                                                  for batch in batches]))
+        return np.concatenate(list(results))
+
+
+def invert(model, parameters, values, initial_temperatures):
+    """Temperatures at which the calibration curves with (samples x parameters) parameters reach the
+    (samples x temperatures) values, by Newton iterations started at initial_temperatures. NaN where it fails."""
+    columns = [parameters[:, [index]] for index in range(parameters.shape[1])]
+    function = dict_of_fitting_functions[model]
+    derivative = dict_of_temperature_derivatives[model]
+    temperatures = np.broadcast_to(np.asarray(initial_temperatures, dtype=np.float64), values.shape).copy()
+    with np.errstate(all='ignore'):
+        for _ in range(newton_iterations):
+            step = (function(temperatures, *columns) - values) / derivative(temperatures, *columns)
+            # the models are only defined for positive temperatures
+            temperatures = np.maximum(temperatures - step, 0.5 * temperatures)
+            if np.nanmax(np.abs(step), initial=0.0) < newton_tolerance:
+                break
+        temperatures[~(np.abs(step) < 1e3 * newton_tolerance)] = np.nan
+    return temperatures
+
+
+class MonteCarloResult:
+    def __init__(self, model, temperatures, parameters, measured_temperatures, fit_x):
+        self.model = model
+        self.temperatures = temperatures
+        self.parameters = parameters  # (samples x model parameters), NaN rows for failed refits
+        self.measured_temperatures = measured_temperatures  # (samples x temperatures)
+        self.fit_x = fit_x
+
+    @property
+    def temperature_errors(self):
+        """Per-temperature deviations of the read-out temperature, (samples x temperatures)."""
+        return self.measured_temperatures - self.temperatures
+
+    @property
+    def temperature_uncertainty(self):
+        return np.nanstd(self.temperature_errors, axis=0, ddof=1)
+
+    @property
+    def converged(self):
+        return np.all(np.isfinite(self.parameters), axis=1)
+
+    def _columns(self):
+        parameters = self.parameters[self.converged]
+        return [parameters[:, [index]] for index in range(parameters.shape[1])]
+
+    def calibration_curves(self):
+        return dict_of_fitting_functions[self.model](self.fit_x, *self._columns())
+
+    def sensitivity_curves(self):
+        return relative_sensitivity(self.model, self.fit_x, self._columns())
+
+    @staticmethod
+    def band(curves, confidence=0.95):
+        """Lower and upper percentile of curves (samples x points) enclosing the confidence fraction."""
+        tail = 50 * (1 - confidence)
+        return tuple(np.nanpercentile(curves, [tail, 100 - tail], axis=0))
+
+    def calibration_band(self, confidence=0.95):
+        return self.band(self.calibration_curves(), confidence)
+
+    def sensitivity_band(self, confidence=0.95):
+        return self.band(self.sensitivity_curves(), confidence)
+
+    def temperature_interval(self, confidence=0.95):
+        return self.band(self.temperature_errors, confidence)
+
+
+@profiled('uncertainty.monte_carlo')
+def monte_carlo(model, temperatures, smoothed_rows, residual_blocks, parameters, fixed_parameters=None, fit_x=None,
+                number_of_samples=1000, noise='bootstrap', seed=None, workers=None):
+    """Propagates spectral noise to the read-out temperature. smoothed_rows holds the noise-free intensities of the
+    numerator and denominator lines, residual_blocks their local residuals. Every sample adds noise to both lines,
+    refits the calibration curve to the noisy ratio and reads the temperatures back from an independently noisy
+    ratio, so the spread contains both the calibration and the measurement uncertainty. The same seed gives the same
+    result for any number of workers."""
+    rng = np.random.default_rng(seed)
+    first, second = smoothed_rows
+
+    def noisy_ratios():
+        return ((first + draw_noise(residual_blocks[0], number_of_samples, rng, noise)) /
+                (second + draw_noise(residual_blocks[1], number_of_samples, rng, noise)))
+
+    calibration_ratios = noisy_ratios()
+    measured_ratios = noisy_ratios()
+    sample_parameters = refit(model, temperatures, calibration_ratios, parameters, fixed_parameters, workers)
+    measured_temperatures = invert(model, sample_parameters, measured_ratios, temperatures)
+    if fit_x is None:
+        fit_x = np.linspace(temperatures[0], temperatures[-1], 1000)
+    return MonteCarloResult(model, np.asarray(temperatures, dtype=np.float64), sample_parameters,
+                            measured_temperatures, fit_x)
@@ -1,5 +1,5 @@
 # ThermLUM - luminescent thermometry data analysis application
-# Copyright (C) 2024  Hubert Dzielak 
+# Copyright (C) 2024  Hubert Dzielak
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -10,11 +10,77 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
-def quantization_to_resolution(value, resolution):
-    if value % resolution == 0.0:
-        quantized_value = value
-    elif value % resolution >= 0.5 * resolution:
-        quantized_value = ((value // resolution) * resolution) + resolution
-    else:
-        quantized_value = (value // resolution) * resolution
-    return quantized_value
+import numpy as np
+
+
+class WavelengthIndex:
+    """Sorted view of a wavelength axis for O(log n) lookups. Works for ascending, descending and non-uniform axes."""
+    def __init__(self, x_data, tolerance=None):
+        self.x_data = np.asarray(x_data, dtype=np.float64)
+        self.order = np.argsort(self.x_data, kind='stable')
+        self.sorted_x_data = self.x_data[self.order]
+        steps = np.diff(self.sorted_x_data)
+        steps = steps[steps > 0]
+        self.resolution = float(np.median(steps)) if len(steps) else 0.0
+        self.minimum_step = float(steps.min()) if len(steps) else 0.0
+        # values closer than a quarter of the smallest step unambiguously name a single axis point
+        self.tolerance = 0.25 * self.minimum_step if tolerance is None else tolerance
+
+    def __len__(self):
+        return len(self.x_data)
+
+    def nearest(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        position = np.clip(np.searchsorted(self.sorted_x_data, values), 1, len(self.sorted_x_data) - 1)
+        lower = self.sorted_x_data[position - 1]
+        upper = self.sorted_x_data[position]
+        position = position - ((values - lower) <= (upper - values))
+        indices = self.order[position]
+        return indices if indices.ndim else int(indices)
+
+    def find(self, values, tolerance=None):
+        """Indices of axis points matching values within tolerance, -1 where there is no such point."""
+        tolerance = self.tolerance if tolerance is None else tolerance
+        indices = np.asarray(self.nearest(values))
+        matched = np.abs(self.x_data[indices] - np.asarray(values, dtype=np.float64)) <= tolerance
+        indices = np.where(matched, indices, -1)
+        return indices if indices.ndim else int(indices)
+
+    def quantize(self, values):
+        quantized = self.x_data[self.nearest(values)]
+        return quantized if np.ndim(quantized) else float(quantized)
+
+    def interpolation_weights(self, values):
+        """Indices of the neighbouring axis points and the weight of the upper one for linear interpolation."""
+        values = np.asarray(values, dtype=np.float64)
+        position = np.clip(np.searchsorted(self.sorted_x_data, values), 1, len(self.sorted_x_data) - 1)
+        lower = self.sorted_x_data[position - 1]
+        upper = self.sorted_x_data[position]
+        weight = np.clip((values - lower) / (upper - lower), 0.0, 1.0)
+        return self.order[position - 1], self.order[position], weight
+
+    def interpolate(self, values, y_data):
+        """Linearly interpolates rows of y_data (first axis along the wavelength axis) at values."""
+        lower, upper, weight = self.interpolation_weights(values)
+        weight = weight[..., np.newaxis] if np.ndim(y_data) > 1 else weight
+        return (1 - weight) * y_data[lower] + weight * y_data[upper]
+
+
+def window_intensities(wavelength_index, y_data, cumulative, windows):
+    """Intensities of y_data (first axis along the wavelength axis) integrated over (start, end) windows, taken from
+    cumulative, its cumulative integral along the axis. A window of zero width gives the intensity interpolated at
+    its wavelength instead, so single lines and bands can be mixed. Returns (windows x columns)."""
+    windows = np.asarray(windows, dtype=np.float64).reshape(-1, 2)
+    edges = wavelength_index.interpolate(windows.ravel(), cumulative)
+    intensities = np.abs(edges[1::2] - edges[0::2])
+    lines = windows[:, 0] == windows[:, 1]
+    if lines.any():
+        intensities[lines] = wavelength_index.interpolate(windows[lines, 0], y_data)
+    return intensities
+
+
+def quantization_to_resolution(value, resolution, wavelength_index=None):
+    if wavelength_index is not None:
+        return wavelength_index.quantize(value)
+    quantized_value = np.floor(np.asarray(value, dtype=np.float64) / resolution + 0.5) * resolution
+    return quantized_value if quantized_value.ndim else float(quantized_value)